@@ -2,24 +2,1337 @@
 Adds Subsonic support to Beets.
 """
 
+import asyncio
 import hashlib
+import json
+import os
+import queue
 import random
+import re
+import sqlite3
 import string
+import threading
+import time
+import unicodedata
 from binascii import hexlify
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
+from urllib.parse import urlencode
 
 import requests
 
-from beets import config, ui
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from beets import config, plugins, ui
+from beets.dbcore import query, types
+from beets.library import Item, parse_query_parts
 from beets.plugins import BeetsPlugin
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from tqdm import tqdm
 
 
+def _normalize(value):
+    """Normalize a metadata string for index lookups."""
+    return " ".join(str(value or "").casefold().split())
+
+
+def _normalize_path(path):
+    """Normalize a path relative to the music folder for index lookups."""
+    path = unicodedata.normalize("NFC", path.replace("\\", "/"))
+    return path.strip("/")
+
+
+# Featured artists in brackets, or after an abbreviation with a dot, so
+# that titles such as "A Feat of Clay" are left alone
+_FEATURING = re.compile(
+    r"\s*[(\[]\s*(?:feat|ft|featuring)\b\.?[^)\]]*[)\]]"
+    r"|\s+(?:feat|ft)\.\s.*$"
+)
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_NUMBERS = re.compile(r"\d+")
+
+
+def _match_key(value):
+    """Normalize a metadata string for matching: compatibility
+    decomposition without accents, casefolded, and without featured
+    artists and punctuation.
+    """
+    value = unicodedata.normalize("NFKD", str(value or ""))
+    value = "".join(c for c in value if not unicodedata.combining(c))
+    value = _FEATURING.sub("", value.casefold())
+    return " ".join(_PUNCTUATION.sub(" ", value).split())
+
+
+def _trigrams(value):
+    """Return the set of character trigrams of a padded match key."""
+    value = f"  {value} "
+    return {value[i : i + 3] for i in range(len(value) - 2)}
+
+
+class MatchKeys:
+    """Normalized match keys of a Subsonic song or a beets item.
+
+    Keys are computed once, so that a song can be compared against any
+    number of items without normalizing its metadata again.
+    """
+
+    __slots__ = (
+        "id",
+        "source",
+        "title",
+        "artist",
+        "album",
+        "duration",
+        "track",
+        "disc",
+    )
+
+    def __init__(
+        self, source, title, artist, album, duration, track, disc, id=None
+    ):
+        self.id = id
+        self.source = source
+        self.title = _match_key(title)
+        self.artist = _match_key(artist)
+        self.album = _match_key(album)
+        self.duration = duration or None
+        self.track = track or None
+        self.disc = disc or 1
+
+    @classmethod
+    def for_song(cls, song):
+        return cls(
+            song,
+            song.get("title"),
+            song.get("artist"),
+            song.get("album"),
+            song.get("duration"),
+            song.get("track"),
+            song.get("discNumber"),
+            song["id"],
+        )
+
+    @classmethod
+    def for_item(cls, item):
+        return cls(
+            item,
+            item.title,
+            item.artist,
+            item.album,
+            item.length,
+            item.track,
+            item.disc,
+        )
+
+
+class SongMatcher:
+    """Score candidate songs against a beets item.
+
+    Title, artist and album similarity, duration and track number are
+    weighted into a score between 0 and 1; fields missing on either side
+    are left out. Only songs whose title matches the item's count at all:
+    equal keys, or keys with the same numbers and a similarity of at
+    least `TITLE_RATIO`. A song at another position on the same album is
+    not a match either. The best candidate scoring at least `threshold`
+    wins. Candidates scoring within `AMBIGUITY_MARGIN` of it are reported.
+    """
+
+    WEIGHTS = {
+        "title": 0.35,
+        "artist": 0.25,
+        "album": 0.15,
+        "duration": 0.2,
+        "track": 0.05,
+    }
+    DURATION_TOLERANCE = 3  # seconds
+    DURATION_RANGE = 10  # seconds beyond the tolerance until no match
+    AMBIGUITY_MARGIN = 0.05
+    TITLE_RATIO = 0.8
+
+    def __init__(self, threshold=0.8, log=None):
+        self.threshold = threshold
+        self._log = log
+
+    def score(self, item, song):
+        """Score how well `song` matches `item`, both :class:`MatchKeys`."""
+        if not self.title_matches(item, song) or self._track(item, song) == 0:
+            return 0.0
+        total = weight_sum = 0.0
+        for field, weight in self.WEIGHTS.items():
+            similarity = getattr(self, f"_{field}")(item, song)
+            if similarity is not None:
+                total += weight * similarity
+                weight_sum += weight
+        return total / weight_sum if weight_sum else 0.0
+
+    @staticmethod
+    def _text(a, b):
+        if not a or not b:
+            return None
+        if a == b:
+            return 1.0
+        return SequenceMatcher(None, a, b).ratio()
+
+    def title_matches(self, item, song):
+        """Whether the titles are close enough for the other fields to
+        count.
+        """
+        if item.title == song.title:
+            return bool(item.title)
+        # "Part 1" and "Part 2" are different songs however similar
+        if _NUMBERS.findall(item.title) != _NUMBERS.findall(song.title):
+            return False
+        return (self._text(item.title, song.title) or 0) >= self.TITLE_RATIO
+
+    def _title(self, item, song):
+        return self._text(item.title, song.title) or 0.0
+
+    def _artist(self, item, song):
+        return self._text(item.artist, song.artist)
+
+    def _album(self, item, song):
+        return self._text(item.album, song.album)
+
+    def _duration(self, item, song):
+        if not item.duration or not song.duration:
+            return None
+        excess = abs(item.duration - song.duration) - self.DURATION_TOLERANCE
+        return max(0.0, 1.0 - max(0.0, excess) / self.DURATION_RANGE)
+
+    def close_in_length(self, item, song):
+        """Whether the durations are within tolerance, or unknown."""
+        if not item.duration or not song.duration:
+            return True
+        return (
+            abs(item.duration - song.duration) <= self.DURATION_TOLERANCE
+        )
+
+    def _track(self, item, song):
+        # Track numbers only tell songs of the same album apart
+        if not item.track or not song.track or not item.album:
+            return None
+        if item.album != song.album:
+            return None
+        return float((item.track, item.disc) == (song.track, song.disc))
+
+    def best(self, item, candidates):
+        """Return the best of the :class:`MatchKeys` `candidates` for
+        `item`, or None if none scores at least the threshold.
+        """
+        scored = sorted(
+            ((self.score(item, song), song) for song in candidates),
+            key=lambda pair: pair[0],
+            reverse=True,
+        )
+        if not scored or scored[0][0] < self.threshold:
+            return None
+        best_score, best = scored[0]
+        rivals = [
+            song
+            for score, song in scored[1:]
+            if song.id != best.id
+            and score >= best_score - self.AMBIGUITY_MARGIN
+        ]
+        if rivals and self._log is not None:
+            self._log.warning(
+                "Ambiguous match for {}: picked {} ({}) over {}",
+                item.source,
+                best.id,
+                best.source.get("title"),
+                ", ".join(
+                    f"{song.id} ({song.source.get('title')})"
+                    for song in rivals
+                ),
+            )
+        return best
+
+
+class CatalogIndex:
+    """In-memory index over a snapshot of the Subsonic song catalog.
+
+    Songs are found by the MusicBrainz recording id that OpenSubsonic
+    servers report as ``musicBrainzId``. Items without a known id are
+    matched on the normalized match keys of title, artist and album,
+    with a looser title and artist key as fallback; candidates sharing a
+    key are scored by `matcher`. Match keys are computed once per song.
+
+    Items that match no key are looked up in a trigram inverted index
+    over title and artist. Shared trigrams are counted from the posting
+    lists; lists longer than `MAX_SCANNED` are only checked for the
+    `MAX_SHORTLISTED` songs sharing the most rarer trigrams. Songs sharing
+    at least `TRIGRAM_OVERLAP` of the item's trigrams are kept, and the
+    `MAX_CANDIDATES` most similar of them are scored.
+
+    Songs are also keyed on their path relative to the server's music
+    folder, after removing `server_prefix`.
+    """
+
+    TRIGRAM_OVERLAP = 0.5
+    MAX_SCANNED = 1000
+    MAX_SHORTLISTED = 100
+    MAX_CANDIDATES = 20
+
+    def __init__(self, server_prefix="", matcher=None):
+        self.server_prefix = _normalize_path(server_prefix)
+        self.matcher = matcher or SongMatcher()
+        self._songs = []
+        self._trigrams = {}
+        self._trigram_counts = []
+        self._by_id = {}
+        self._by_path = {}
+        self._by_mbid = {}
+        self._by_album = {}
+        self._by_artist = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def add(self, song):
+        keys = MatchKeys.for_song(song)
+        self._by_id[song["id"]] = song
+        trigrams = _trigrams(f"{keys.title} {keys.artist}")
+        for trigram in trigrams:
+            self._trigrams.setdefault(trigram, []).append(len(self._songs))
+        self._trigram_counts.append(len(trigrams))
+        self._songs.append(keys)
+        if song.get("musicBrainzId"):
+            self._by_mbid.setdefault(song["musicBrainzId"], []).append(keys)
+        if song.get("path"):
+            path = _normalize_path(song["path"])
+            if self.server_prefix and path.startswith(
+                self.server_prefix + "/"
+            ):
+                path = path[len(self.server_prefix) + 1 :]
+            self._by_path[path] = song
+        self._by_album.setdefault(
+            (keys.title, keys.artist, keys.album), []
+        ).append(keys)
+        self._by_artist.setdefault((keys.title, keys.artist), []).append(keys)
+
+    def get(self, song_id):
+        """Return the song with the given Subsonic id, or None."""
+        return self._by_id.get(song_id)
+
+    def lookup_path(self, path):
+        """Return the Subsonic id of the song at `path`, relative to the
+        music folder, or None.
+        """
+        song = self._by_path.get(_normalize_path(path))
+        return None if song is None else song["id"]
+
+    def lookup(self, item, fuzzy=True):
+        """Return the Subsonic id of the song matching `item`, or None.
+
+        Unless `fuzzy` is set, only MusicBrainz id and match key hits are
+        returned, without falling back to the trigram index.
+        """
+        keys = MatchKeys.for_item(item)
+        if item.mb_trackid:
+            # A recording can appear on several albums
+            candidates = self._by_mbid.get(item.mb_trackid)
+            if candidates:
+                return max(
+                    candidates,
+                    key=lambda song: self.matcher.score(keys, song),
+                ).id
+
+        for candidates in (
+            self._by_album.get((keys.title, keys.artist, keys.album)),
+            self._by_artist.get((keys.title, keys.artist)),
+        ):
+            if candidates:
+                song = self.matcher.best(keys, candidates)
+                if song is not None:
+                    return song.id
+
+        if not fuzzy:
+            return None
+        song = self.matcher.best(keys, self.search(keys))
+        return None if song is None else song.id
+
+    def search(self, keys):
+        """Return the :class:`MatchKeys` of the songs most similar in
+        title and artist to the :class:`MatchKeys` `keys`.
+        """
+        trigrams = _trigrams(f"{keys.title} {keys.artist}")
+        needed = max(1, int(len(trigrams) * self.TRIGRAM_OVERLAP))
+        # Count the trigrams each song shares with the item while walking
+        # the posting lists. Trigrams common enough to exceed `MAX_SCANNED`
+        # are only checked for the songs shortlisted on the rarer ones.
+        shared = Counter()
+        common = []
+        for trigram in trigrams:
+            posting = self._trigrams.get(trigram)
+            if not posting:
+                continue
+            if len(posting) > self.MAX_SCANNED:
+                common.append(posting)
+            else:
+                shared.update(posting)
+        if not shared and common:
+            common.sort(key=len)
+            shared.update(common.pop(0))
+
+        similar = []
+        for position, count in shared.most_common(self.MAX_SHORTLISTED):
+            if count + len(common) < needed:
+                break
+            # Positions are appended in order, so posting lists are sorted
+            for posting in common:
+                index = bisect_left(posting, position)
+                if index < len(posting) and posting[index] == position:
+                    count += 1
+            if count >= needed:
+                total = len(trigrams) + self._trigram_counts[position]
+                similar.append((2 * count / total, position))
+        similar.sort(reverse=True)
+        return [
+            self._songs[position]
+            for _, position in similar[: self.MAX_CANDIDATES]
+        ]
+
+
+def _match_album_track(item, songs, matcher):
+    """Find the song of an album tracklist that corresponds to `item`.
+
+    `songs` are the :class:`MatchKeys` of the tracklist. A song with the
+    item's MusicBrainz recording id is taken first. Disc and track number
+    are tried next, confirmed by title or duration; the best-scoring song
+    comes last.
+    """
+    keys = MatchKeys.for_item(item)
+
+    if item.mb_trackid:
+        for song in songs:
+            if song.source.get("musicBrainzId") == item.mb_trackid:
+                return song.id
+
+    if keys.track:
+        for song in songs:
+            if (song.track, song.disc) != (keys.track, keys.disc):
+                continue
+            if keys.title == song.title or (
+                matcher.title_matches(keys, song)
+                and matcher.close_in_length(keys, song)
+            ):
+                return song.id
+
+    song = matcher.best(keys, songs)
+    return None if song is None else song.id
+
+
+class MissingFlexQuery(query.Query):
+    """Match items without a value for the flexible attribute `field`.
+
+    The test runs in SQL against the flexible attribute table, so that
+    only the matching items are loaded from the library.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def clause(self):
+        return (
+            "NOT EXISTS (SELECT 1 FROM item_attributes "
+            "WHERE item_attributes.entity_id = items.id "
+            "AND item_attributes.key = ? "
+            "AND item_attributes.value IS NOT NULL "
+            "AND item_attributes.value != '')",
+            [self.field],
+        )
+
+    def match(self, item):
+        return not item.get(self.field)
+
+
+class IdsQuery(query.Query):
+    """Match the items with the given ids."""
+
+    def __init__(self, ids):
+        self.ids = list(ids)
+
+    def clause(self):
+        placeholders = ", ".join("?" * len(self.ids))
+        return f"items.id IN ({placeholders})", self.ids
+
+    def match(self, item):
+        return item.id in self.ids
+
+
+class ItemStream:
+    """Items matching a query, loaded lazily a page at a time.
+
+    Unlike the `Results` returned by `lib.items()`, items are not kept
+    once they have been handed out, and the length is computed with a
+    ``COUNT(*)`` query instead of loading every item. Queries that
+    cannot be evaluated in SQL fall back to `lib.items()`.
+    """
+
+    def __init__(self, lib, item_query, page_size=500):
+        self.lib = lib
+        self.query = item_query
+        self.page_size = page_size
+        self._count = None
+        self._fallback = None
+
+    def _fallback_results(self):
+        if self._fallback is None:
+            self._fallback = self.lib.items(self.query)
+        return self._fallback
+
+    def _sql(self, statement, subvals):
+        """Run `statement` with the query as WHERE clause, or return None
+        if the query cannot be expressed in SQL on the items table.
+        """
+        where, where_subvals = self.query.clause()
+        if where is None:
+            return None
+        try:
+            with self.lib.transaction() as tx:
+                return tx.query(
+                    statement.format(where=where),
+                    list(where_subvals) + list(subvals),
+                )
+        except sqlite3.OperationalError:
+            # e.g. album fields, which need a join with the albums table
+            return None
+
+    def __len__(self):
+        if self._count is None:
+            rows = self._sql("SELECT COUNT(*) FROM items WHERE {where}", ())
+            if rows is None:
+                self._count = len(self._fallback_results())
+            else:
+                self._count = rows[0][0]
+        return self._count
+
+    def __iter__(self):
+        last_id = 0
+        while True:
+            rows = self._sql(
+                "SELECT id FROM items WHERE ({where}) AND id > ? "
+                "ORDER BY id LIMIT ?",
+                (last_id, self.page_size),
+            )
+            if rows is None:
+                yield from self._fallback_results()
+                return
+            if not rows:
+                return
+            ids = [row[0] for row in rows]
+            yield from self.lib.items(IdsQuery(ids))
+            last_id = ids[-1]
+
+
+class ItemWriter:
+    """Store items from a single background thread.
+
+    Lookups run on worker threads while all library writes are funnelled
+    through one writer, so SQLite never sees concurrent writers. Items
+    are committed in transactions of up to `batch_size` items; a partial
+    batch is committed once no new item has arrived for `idle` seconds.
+    `on_commit` is called with the items stored by each transaction once
+    it has been committed.
+    """
+
+    def __init__(
+        self, log, batch_size=500, idle=1.0, maxsize=1000, on_commit=None
+    ):
+        self._log = log
+        self.batch_size = max(1, batch_size)
+        self.idle = idle
+        self.on_commit = on_commit
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.stored = 0
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._queue.put(None)
+        self._thread.join()
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def _run(self):
+        batch = []
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle if batch else None)
+            except queue.Empty:
+                self._commit(batch)
+                batch = []
+                continue
+            if item is None:
+                break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._commit(batch)
+                batch = []
+        self._commit(batch)
+
+    def _commit(self, batch):
+        if not batch:
+            return
+        stored = []
+        with batch[0]._db.transaction():
+            for item in batch:
+                try:
+                    item.store()
+                    stored.append(item)
+                except Exception as error:
+                    self._log.error(f"Could not store {item}: {error}")
+        self.stored += len(stored)
+        if self.on_commit is not None and stored:
+            self.on_commit(stored)
+
+
+class ResponseCache:
+    """SQLite-backed cache for responses of read-only endpoints.
+
+    Keys are built from the endpoint name and its sorted parameters,
+    leaving out authentication parameters so that rotating salts and
+    tokens do not defeat the cache. Entries expire after `ttl` seconds
+    and the least recently used entries are evicted once the cache
+    holds more than `max_entries` responses.
+    """
+
+    ENDPOINTS = {"search3", "getAlbum", "getAlbumList2", "getSong"}
+    AUTH_PARAMS = {"u", "t", "s", "p", "v", "c", "f", "apiKey"}
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA synchronous = OFF")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, body TEXT, created REAL, accessed REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed "
+            "ON responses (accessed)"
+        )
+        self._conn.commit()
+        self._size = self._conn.execute(
+            "SELECT COUNT(*) FROM responses"
+        ).fetchone()[0]
+
+    @classmethod
+    def make_key(cls, endpoint, params, version=""):
+        """Key a response on its request and the version of the server
+        library it was read from, so that responses from before a scan
+        are never served afterwards.
+        """
+        params = sorted(
+            (key, str(value))
+            for key, value in params.items()
+            if key not in cls.AUTH_PARAMS
+        )
+        return f"{endpoint}?{urlencode(params)}#{version}"
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key = ?", (key,)
+                )
+                self._conn.commit()
+                self._size -= 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, body):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, json.dumps(body), now, now),
+            )
+            self._size += cursor.rowcount
+            if self._size > self.max_entries:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries down to 90% of the cap."""
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+            (self._size - int(self.max_entries * 0.9),),
+        )
+        self._size = self._conn.execute(
+            "SELECT COUNT(*) FROM responses"
+        ).fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _fingerprint(item):
+    """Hash the metadata that song lookups depend on."""
+    fields = (item.title, item.artist, item.album, round(item.length or 0))
+    return hashlib.md5(repr(fields).encode("utf-8")).hexdigest()
+
+
+class StateStore:
+    """SQLite database for plugin state kept between runs.
+
+    Holds the items that could not be found on the server, keyed by item
+    id and a fingerprint of the metadata used for the search, so that
+    they are only searched again once their metadata changes or the
+    server library is rescanned; the library version they were recorded
+    against is kept alongside. It also keeps ledgers of the plays the
+    server has acknowledged, so that scrobbles are never sent twice, and
+    of the last rating pushed for each song and rating field, the
+    journals of interrupted bulk commands, and the imported items still
+    waiting for a subsonic_id.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS missing ("
+            "item_id INTEGER PRIMARY KEY, fingerprint TEXT)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS scrobbles ("
+            "item_id INTEGER, time INTEGER, PRIMARY KEY (item_id, time))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ratings ("
+            "song_id TEXT, field TEXT, rating INTEGER, "
+            "PRIMARY KEY (song_id, field))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "run TEXT, item_id INTEGER, PRIMARY KEY (run, item_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS imported (item_id INTEGER PRIMARY KEY)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._conn.commit()
+
+    def is_missing(self, item_id, fingerprint):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fingerprint FROM missing WHERE item_id = ?",
+                (item_id,),
+            ).fetchone()
+        return row is not None and row[0] == fingerprint
+
+    def add_missing(self, item_id, fingerprint):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO missing VALUES (?, ?)",
+                (item_id, fingerprint),
+            )
+            self._conn.commit()
+
+    def forget_missing(self, item_id):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM missing WHERE item_id = ?", (item_id,)
+            )
+            self._conn.commit()
+
+    def sync_missing(self, version):
+        """Forget the missing items if they were recorded against another
+        version of the server library.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'missing_version'"
+            ).fetchone()
+            if row is not None and row[0] == version:
+                return
+            self._conn.execute("DELETE FROM missing")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('missing_version', ?)",
+                (version,),
+            )
+            self._conn.commit()
+
+    def scrobbled(self):
+        """Return the set of ``(item_id, time)`` plays already sent."""
+        with self._lock:
+            return set(self._conn.execute("SELECT * FROM scrobbles"))
+
+    def add_scrobbles(self, plays):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO scrobbles VALUES (?, ?)", plays
+            )
+            self._conn.commit()
+
+    def pushed_rating(self, song_id, field):
+        """Return the rating last pushed for a song, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rating FROM ratings WHERE song_id = ? AND field = ?",
+                (song_id, field),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def add_pushed_rating(self, song_id, field, rating):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ratings VALUES (?, ?, ?)",
+                (song_id, field, rating),
+            )
+            self._conn.commit()
+
+    def journal(self, run):
+        """Return the ids of the items completed by `run`."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT item_id FROM journal WHERE run = ?", (run,)
+            )
+            return {row[0] for row in rows}
+
+    def add_to_journal(self, run, item_ids):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO journal VALUES (?, ?)",
+                ((run, item_id) for item_id in item_ids),
+            )
+            self._conn.commit()
+
+    def clear_journal(self, run):
+        with self._lock:
+            self._conn.execute("DELETE FROM journal WHERE run = ?", (run,))
+            self._conn.commit()
+
+    def imported(self):
+        """Return the ids of imported items waiting for a subsonic_id."""
+        with self._lock:
+            rows = self._conn.execute("SELECT item_id FROM imported")
+            return [row[0] for row in rows]
+
+    def add_imported(self, item_ids):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO imported VALUES (?)",
+                ((item_id,) for item_id in item_ids),
+            )
+            self._conn.commit()
+
+    def forget_imported(self, item_ids):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM imported WHERE item_id = ?",
+                ((item_id,) for item_id in item_ids),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Journal:
+    """Record the items a bulk command has completed, so that an
+    interrupted run can be resumed where it stopped.
+
+    A run is identified by the command and its arguments. Unless
+    `resume` is set, the previous journal of the run is discarded. Items
+    can be added from several threads.
+    """
+
+    def __init__(self, store, run, resume=False, flush_every=100):
+        self._store = store
+        self.run = run
+        self.flush_every = flush_every
+        self._pending = []
+        self._lock = threading.Lock()
+        if resume:
+            self.done = store.journal(run)
+        else:
+            store.clear_journal(run)
+            self.done = set()
+
+    def __contains__(self, item_id):
+        return item_id in self.done
+
+    def add(self, *item_ids):
+        with self._lock:
+            self._pending.extend(item_ids)
+            if len(self._pending) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._store.add_to_journal(self.run, self._pending)
+            self._pending = []
+
+    def finish(self):
+        """Forget the journal once the run has completed."""
+        with self._lock:
+            self._pending = []
+            self._store.clear_journal(self.run)
+
+
+class ScanLock:
+    """Coordinate library scans between concurrent beets processes.
+
+    The file at `path` holds the time the last scan was started. It is
+    locked while a process decides whether to scan, so that processes
+    finishing at the same time share a single scan. Locking needs
+    :mod:`fcntl`; elsewhere only the timestamp is checked.
+    """
+
+    def __init__(self, path, debounce):
+        self.path = path
+        self.debounce = debounce
+        self._file = None
+
+    @contextmanager
+    def hold(self):
+        with open(self.path, "a+") as self._file:
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                self._file = None
+
+    def last_scan(self):
+        self._file.seek(0)
+        try:
+            return float(self._file.read().strip() or 0)
+        except ValueError:
+            return 0.0
+
+    def remaining(self):
+        """Seconds until the debounce window of the last scan has passed."""
+        return max(0.0, self.last_scan() + self.debounce - time.time())
+
+    def mark(self):
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(str(time.time()))
+        self._file.flush()
+
+
+class TransportError(Exception):
+    """A request failed before the server could answer it, or was not
+    sent at all.
+    """
+
+
+class RetryPolicy:
+    """How often and how patiently to retry a failed request.
+
+    Waits grow exponentially from `backoff` up to `max_backoff` seconds
+    with full jitter, unless the server asks for a specific delay with a
+    ``Retry-After`` header.
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, attempts, backoff, max_backoff):
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait after the failed attempt number `attempt`."""
+        seconds = _parse_retry_after(retry_after)
+        if seconds is not None:
+            return min(seconds, self.max_backoff)
+        ceiling = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+
+def _parse_retry_after(value):
+    """Parse a ``Retry-After`` header into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """Stop sending requests to a server that keeps failing.
+
+    After `threshold` consecutive failed requests the breaker opens and
+    requests are aborted without being sent. Once `cooldown` seconds
+    have passed, a single trial request is let through; its outcome
+    closes the breaker again or restarts the cooldown.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or time.monotonic() - self._opened < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, success):
+        """Record the outcome of a request.
+
+        :return: True if this failure opened the breaker
+        """
+        with self._lock:
+            self._trial = False
+            if success:
+                self._failures = 0
+                self._opened = None
+                return False
+            self._failures += 1
+            if self._failures < self.threshold:
+                return False
+            opened = self._opened is None
+            self._opened = time.monotonic()
+            return opened
+
+
+class ConcurrencyController:
+    """Additive-increase/multiplicative-decrease concurrency limit.
+
+    Request latencies and outcomes are collected in rounds of roughly
+    `limit` requests. After a round without failures whose mean latency
+    stayed below `target_latency`, the limit grows by one; otherwise it
+    is halved. The limit always stays between `minimum` and `maximum`.
+    """
+
+    def __init__(self, initial, minimum, maximum, target_latency):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.target_latency = target_latency
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._failed = False
+
+    def record(self, latency, success):
+        with self._lock:
+            self._latencies.append(latency)
+            self._failed = self._failed or not success
+            if len(self._latencies) < self.limit:
+                return
+            mean = sum(self._latencies) / len(self._latencies)
+            if self._failed or mean > self.target_latency:
+                self.limit = max(self.minimum, self.limit // 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1)
+            self._latencies = []
+            self._failed = False
+
+
+class RequestStats:
+    """Thread-safe counters of completed, failed and aborted requests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.aborted = 0
+
+    def add(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def __str__(self):
+        return (
+            f"{self.completed} completed, {self.failed} failed, "
+            f"{self.aborted} aborted"
+        )
+
+
+class Credentials:
+    """Authentication parameters shared by all requests of a session.
+
+    The parameters are computed once and handed out as an immutable
+    mapping. With token authentication, a new salt and token are
+    generated every `salt_ttl` seconds if it is set.
+    """
+
+    def __init__(self, user, password, auth, salt_ttl=0, api_key=None):
+        self.user = user
+        self.auth = auth
+        self.salt_ttl = salt_ttl
+        self._password = password
+        self._api_key = api_key
+        self._lock = threading.Lock()
+        self._payload = None
+        self._created = 0
+
+        if auth not in ("token", "password", "apikey"):
+            raise ValueError(f"Invalid authentication method: {auth}")
+
+    def payload(self):
+        with self._lock:
+            expired = (
+                self.auth == "token"
+                and self.salt_ttl
+                and time.monotonic() - self._created > self.salt_ttl
+            )
+            if self._payload is None or expired:
+                self._payload = MappingProxyType(self._build())
+                self._created = time.monotonic()
+            return self._payload
+
+    def _build(self):
+        if self.auth == "apikey":
+            return {
+                "apiKey": self._api_key,
+                "v": "1.16.1",  # OpenSubsonic
+                "c": "beets",
+                "f": "json",
+            }
+        elif self.auth == "token":
+            salt, token = self._create_token()
+            return {
+                "u": self.user,
+                "t": token,
+                "s": salt,
+                "v": "1.13.0",  # Subsonic 5.3 and newer
+                "c": "beets",
+                "f": "json",
+            }
+        else:
+            encpass = hexlify(self._password.encode()).decode()
+            return {
+                "u": self.user,
+                "p": f"enc:{encpass}",
+                "v": "1.12.0",
+                "c": "beets",
+                "f": "json",
+            }
+
+    def _create_token(self):
+        """Create salt and token from given password.
+
+        :return: The generated salt and hashed token
+        """
+        # Pick the random sequence and salt the password
+        r = string.ascii_letters + string.digits
+        salt = "".join([random.choice(r) for _ in range(6)])
+        salted_password = self._password + salt
+        token = hashlib.md5(salted_password.encode("utf-8")).hexdigest()
+        return salt, token
+
+
+class AsyncEngine:
+    """Run the plugin's request flows as asyncio tasks over aiohttp.
+
+    A request flow is a generator that yields ``(url, payload)`` pairs
+    and receives the checked response for each of them, returning its
+    result when done (see :meth:`SubsonicPlugin.run_flow`). The engine
+    runs `concurrency` flows at a time on a single thread.
+
+    Everything that may block runs outside the event loop: flows are
+    advanced on worker threads, as they use the state store, and so are
+    response cache lookups. Items are read and results handled on one
+    extra thread, in order.
+    """
+
+    def __init__(self, plugin, concurrency, timeout):
+        self._plugin = plugin
+        self._log = plugin._log
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+
+    def run(self, items, flow, on_result):
+        """Run ``flow(item)`` for all items, calling
+        ``on_result(item, result)`` as each flow completes.
+        """
+        plugin = self._plugin
+        if (
+            plugin._remember_missing
+            or plugin.response_cache() is not None
+        ):
+            # Check the server up front rather than from the event loop
+            plugin.library_version()
+        with ThreadPoolExecutor(max_workers=1) as serial:
+            asyncio.run(self._run(items, flow, on_result, serial))
+
+    async def _run(self, items, flow, on_result, serial):
+        loop = asyncio.get_running_loop()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            self._session = session
+            iterator = iter(items)
+
+            async def worker():
+                while True:
+                    item = await loop.run_in_executor(
+                        serial, next, iterator, None
+                    )
+                    if item is None:
+                        return
+                    result = await self.drive(flow(item))
+                    await loop.run_in_executor(
+                        serial, on_result, item, result
+                    )
+
+            await asyncio.gather(
+                *(worker() for _ in range(self.concurrency))
+            )
+        self._session = None
+
+    async def drive(self, steps):
+        """Run a request flow to completion.
+
+        A flow that raises is abandoned with a logged error, so that one
+        bad item does not stop the other flows.
+        """
+        try:
+            done, value = await asyncio.to_thread(_advance, steps, None)
+            while not done:
+                json = await self.request(*value)
+                done, value = await asyncio.to_thread(_advance, steps, json)
+            return value
+        except Exception as error:
+            self._log.error(f"Request failed: {error!r}")
+            steps.close()
+            return None
+
+    async def request(self, url, payload):
+        plugin = self._plugin
+        json = await asyncio.to_thread(plugin.cached_response, url, payload)
+        if json is not None:
+            return json
+        if not plugin.allow_request():
+            return None
+
+        started = time.monotonic()
+        policy = plugin.retry_policy(url)
+        for attempt in range(1, policy.attempts + 1):
+            retry_after = None
+            try:
+                async with self._session.get(url, params=payload) as response:
+                    if response.status not in RetryPolicy.RETRY_STATUS:
+                        response.raise_for_status()
+                        json = await response.json(content_type=None)
+                        break
+                    retry_after = response.headers.get("Retry-After")
+                    error = f"HTTP {response.status}"
+            except asyncio.TimeoutError:
+                error = "timeout"
+            except aiohttp.ClientConnectionError as connection_error:
+                error = f"{connection_error!r}"
+            except aiohttp.ClientError as client_error:
+                plugin.record_request(False, f"{client_error!r}", started)
+                return None
+            except ValueError as value_error:
+                plugin.record_request(True, started=started)
+                self._log.error(
+                    f"Invalid JSON response from server: {value_error}"
+                )
+                return None
+            if attempt == policy.attempts:
+                plugin.record_request(False, error, started)
+                return None
+            delay = policy.delay(attempt, retry_after)
+            self._log.debug(f"Retrying in {delay:.1f}s after {error}")
+            await asyncio.sleep(delay)
+
+        plugin.record_request(True, started=started)
+        json = plugin.check_response(json)
+        if json:
+            await asyncio.to_thread(plugin.store_response, url, payload, json)
+        return json
+
+
+def _advance(steps, json):
+    """Send `json` to a request flow.
+
+    :return: ``(False, request)`` for the next request of the flow, or
+        ``(True, result)`` once it has returned
+    """
+    try:
+        return False, steps.send(json)
+    except StopIteration as stop:
+        return True, stop.value
+
+
 class SubsonicPlugin(BeetsPlugin):
     """Subsonic plugin for Beets."""
 
     data_source = "Subsonic"
     MAX_WORKERS = 3
+    NON_IDEMPOTENT = {"scrobble"}
+    SCAN_POLL = 1.0
+    SCAN_MAX_POLL = 15.0
+    SCAN_CHECK_INTERVAL = 300
+
+    item_types = {
+        "subsonic_userrating": types.INTEGER,
+        "subsonic_starred": types.BOOLEAN,
+        "subsonic_playcount": types.INTEGER,
+    }
 
     def __init__(self):
         super().__init__()
@@ -31,20 +1344,173 @@ class SubsonicPlugin(BeetsPlugin):
                 "url": "http://localhost:4533",
                 "auth": "token",
                 "auto_scan": True,
+                "scan_debounce": 60,
+                "auto_getids": False,
+                "scan_timeout": 600,
+                "path_prefix": {
+                    "local": "",
+                    "server": "",
+                },
+                "match_threshold": 0.8,
+                "catalog_page_size": 500,
+                "cache": {
+                    "enabled": False,
+                    "path": "",
+                    "ttl": 7 * 24 * 3600,
+                    "max_entries": 100000,
+                },
+                "remember_missing": True,
+                "state_path": "",
+                "engine": "threads",
+                "concurrency": 50,
+                "api_key": "",
+                "salt_ttl": 0,
+                "timeout": 5.0,
+                "retry": {
+                    "attempts": 3,
+                    "backoff": 0.5,
+                    "max_backoff": 30,
+                    "endpoints": {},
+                },
+                "breaker": {
+                    "threshold": 10,
+                    "cooldown": 60,
+                },
+                "scrobble_batch_size": 1,
+                "write_batch_size": 500,
+                "adaptive": {
+                    "min_workers": 1,
+                    "max_workers": 16,
+                    "target_latency": 1.0,
+                },
             }
         )
         config["subsonic"]["pass"].redact = True
+        config["subsonic"]["api_key"].redact = True
         self.session = requests.Session()
+        self._base_url = None
+        self._credentials = None
+        self._credentials_lock = threading.Lock()
+        self._retry_policies = {}
+        # Options read on every request or item
+        self._timeout = self.config["timeout"].as_number()
+        self._remember_missing = self.config["remember_missing"].get(bool)
+        self.breaker = CircuitBreaker(
+            self.config["breaker"]["threshold"].get(int),
+            self.config["breaker"]["cooldown"].as_number(),
+        )
+        self.request_stats = RequestStats()
+        self.matcher = SongMatcher(
+            self.config["match_threshold"].as_number(), self._log
+        )
+        adaptive = self.config["adaptive"]
+        self.concurrency = ConcurrencyController(
+            self.MAX_WORKERS,
+            adaptive["min_workers"].get(int),
+            adaptive["max_workers"].get(int),
+            adaptive["target_latency"].as_number(),
+        )
+        self._pool_size = 0
+        self.size_connection_pool(self.concurrency.maximum)
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._library_version = None
+        self._version_checked = None
+        self._version_lock = threading.Lock()
+        self._state = None
+        self._state_lock = threading.Lock()
+        self._scan_requested = False
+        self._scan_suppressed = False
+        self._changed_at = None
+        self._lib = None
         self.register_listener("database_change", self.db_change)
         self.register_listener("smartplaylist_update", self.spl_update)
+        self.register_listener("item_imported", self.item_imported)
+        self.register_listener("album_imported", self.album_imported)
 
     def db_change(self, lib, model):
-        if self.config["auto_scan"].get(bool):
-            self.register_listener("cli_exit", self.start_scan)
+        self.request_scan()
 
     def spl_update(self):
-        if self.config["auto_scan"].get(bool):
-            self.register_listener("cli_exit", self.start_scan)
+        self.request_scan()
+
+    def request_scan(self):
+        """Scan the Subsonic library once, when beets exits."""
+        if self._scan_suppressed or not self.config["auto_scan"].get(bool):
+            return
+        self._changed_at = time.time()
+        if self._scan_requested:
+            return
+        self._scan_requested = True
+        self.register_listener("cli_exit", self.deferred_scan)
+
+    @contextmanager
+    def scan_suppressed(self):
+        """Store data that came from the server without requesting a
+        scan of it.
+        """
+        suppressed, self._scan_suppressed = self._scan_suppressed, True
+        try:
+            yield
+        finally:
+            self._scan_suppressed = suppressed
+
+    def deferred_scan(self, lib=None):
+        """Start the scan requested by library changes, unless another
+        beets process started one since the last change.
+
+        With `auto_getids`, wait for the scan to complete when items were
+        imported, so that their ids can be resolved. Only a scan started
+        by this process is sure to include them; otherwise they are left
+        for a later one.
+        """
+        started = self.start_scan(changed_at=self._changed_at)
+        if (
+            started
+            and self._lib is not None
+            and self.config["auto_getids"].get(bool)
+        ):
+            self.wait_for_scan(
+                self.config["scan_timeout"].as_number(), resolve=True
+            )
+
+    def item_imported(self, lib, item):
+        self.record_imported(lib, [item.id])
+
+    def album_imported(self, lib, album):
+        self.record_imported(lib, [item.id for item in album.items()])
+
+    def record_imported(self, lib, item_ids):
+        """Remember imported items, to resolve their subsonic_id once the
+        server has scanned them.
+        """
+        if not self.config["auto_getids"].get(bool):
+            return
+        self._lib = lib
+        self.state_store().add_imported(item_ids)
+
+    def resolve_imported(self):
+        """Get the subsonic_id of the items imported since the last scan.
+
+        Items that are still not found stay pending for the next scan.
+        """
+        if self._lib is None or not self.config["auto_getids"].get(bool):
+            return
+        store = self.state_store()
+        item_ids = store.imported()
+        if not item_ids:
+            return
+        self._log.info(f"Getting subsonic_id for {len(item_ids)} new items")
+        item_query = query.AndQuery(
+            [IdsQuery(item_ids), MissingFlexQuery("subsonic_id")]
+        )
+        with self.scan_suppressed():
+            self.subsonic_get_ids(ItemStream(self._lib, item_query), False)
+        # Items deleted from the library in the meantime are dropped too
+        pending = {item.id for item in ItemStream(self._lib, item_query)}
+        store.forget_imported(
+            [item_id for item_id in item_ids if item_id not in pending]
+        )
 
     def commands(self):
         """Add beet UI commands to interact with Subsonic."""
@@ -54,8 +1520,28 @@ class SubsonicPlugin(BeetsPlugin):
             "subsonic_update", help=f"Update {self.data_source} library"
         )
 
+        subsonicupdate_cmd.parser.add_option(
+            "-w",
+            "--wait",
+            dest="wait",
+            action="store_true",
+            default=False,
+            help="Wait for the scan to complete, reporting its progress",
+        )
+
+        subsonicupdate_cmd.parser.add_option(
+            "--timeout",
+            dest="timeout",
+            type="float",
+            default=None,
+            help="Stop waiting for the scan after this many seconds",
+        )
+
         def func(lib, opts, args):
-            self.start_scan()
+            self._lib = lib
+            started = self.start_scan()
+            if opts.wait:
+                self.wait_for_scan(opts.timeout, resolve=started)
 
         subsonicupdate_cmd.func = func
 
@@ -76,9 +1562,46 @@ class SubsonicPlugin(BeetsPlugin):
             ),
         )
 
+        subsonicaddrating_cmd.parser.add_option(
+            "-d",
+            "--diff",
+            dest="diff",
+            action="store_true",
+            default=False,
+            help=(
+                "Read current ratings from the server first and only "
+                "send the ones that changed"
+            ),
+        )
+
+        subsonicaddrating_cmd.parser.add_option(
+            "-f",
+            "--force",
+            dest="force",
+            action="store_true",
+            default=False,
+            help="Also send ratings that have not changed since last push",
+        )
+
+        subsonicaddrating_cmd.parser.add_option(
+            "--resume",
+            dest="resume",
+            action="store_true",
+            default=False,
+            help="Skip items completed by an interrupted run",
+        )
+
         def func_add_rating(lib, opts, args):
-            items = lib.items(ui.decargs(args))
-            self.subsonic_add_rating(items, opts.rating)
+            item_query, _ = parse_query_parts(ui.decargs(args), Item)
+            items = ItemStream(lib, item_query)
+            journal = self.journal(
+                opts.resume, "subsonic_addrating", opts.rating, *args
+            )
+            with self.resumable(journal):
+                self.subsonic_add_rating(
+                    items, opts.rating, opts.diff, opts.force, journal
+                )
+            self.report_requests()
 
         subsonicaddrating_cmd.func = func_add_rating
 
@@ -96,9 +1619,83 @@ class SubsonicPlugin(BeetsPlugin):
             help="Force subsonic_id update",
         )
 
+        subsonic_get_ids_cmd.parser.add_option(
+            "-c",
+            "--catalog",
+            dest="catalog",
+            action="store_true",
+            default=False,
+            help=(
+                "Resolve ids against a snapshot of the whole server catalog "
+                "instead of searching for every item"
+            ),
+        )
+
+        subsonic_get_ids_cmd.parser.add_option(
+            "-w",
+            "--workers",
+            dest="workers",
+            type="int",
+            default=None,
+            help=(
+                "Number of concurrent lookups. By default, concurrency "
+                "adapts to the server's latency and error rate."
+            ),
+        )
+
+        subsonic_get_ids_cmd.parser.add_option(
+            "-a",
+            "--albums",
+            dest="albums",
+            action="store_true",
+            default=False,
+            help=(
+                "Resolve ids album by album, matching tracks against the "
+                "album tracklist"
+            ),
+        )
+
+        subsonic_get_ids_cmd.parser.add_option(
+            "-p",
+            "--paths",
+            dest="paths",
+            action="store_true",
+            default=False,
+            help=(
+                "Match items against a catalog snapshot by their path in "
+                "the music folder shared with the server"
+            ),
+        )
+
+        subsonic_get_ids_cmd.parser.add_option(
+            "--resume",
+            dest="resume",
+            action="store_true",
+            default=False,
+            help="Skip items completed by an interrupted run",
+        )
+
         def func_get_ids(lib, opts, args):
-            items = lib.items(ui.decargs(args))
-            self.subsonic_get_ids(items, opts.force_refetch)
+            item_query, _ = parse_query_parts(ui.decargs(args), Item)
+            if not opts.force_refetch:
+                item_query = query.AndQuery(
+                    [item_query, MissingFlexQuery("subsonic_id")]
+                )
+            items = ItemStream(lib, item_query)
+            journal = self.journal(
+                opts.resume, "subsonic_getids", opts.force_refetch, *args
+            )
+            with self.resumable(journal):
+                self.subsonic_get_ids(
+                    items,
+                    opts.force_refetch,
+                    opts.catalog,
+                    opts.workers,
+                    opts.albums,
+                    journal,
+                    opts.paths,
+                )
+            self.report_requests()
 
         subsonic_get_ids_cmd.func = func_get_ids
 
@@ -107,45 +1704,69 @@ class SubsonicPlugin(BeetsPlugin):
             "subsonic_scrobble", help="Scrobble tracks"
         )
 
+        subsonic_scrobble_cmd.parser.add_option(
+            "-b",
+            "--batch-size",
+            dest="batch_size",
+            type="int",
+            default=None,
+            help=(
+                "Number of plays sent per scrobble request. "
+                "Default is the scrobble_batch_size option."
+            ),
+        )
+
+        subsonic_scrobble_cmd.parser.add_option(
+            "-f",
+            "--force",
+            dest="force",
+            action="store_true",
+            default=False,
+            help="Also resend plays that were already scrobbled",
+        )
+
         def func_scrobble(lib, opts, args):
             items = lib.items(ui.decargs(args))
-            self.subsonic_scrobble(items)
+            self.subsonic_scrobble(items, opts.batch_size, opts.force)
+            self.report_requests()
+
+        subsonic_scrobble_cmd.func = func_scrobble
+
+        # pull ratings
+        subsonic_pull_ratings_cmd = ui.Subcommand(
+            "subsonic_pullratings",
+            help=f"Import ratings and play counts from {self.data_source}",
+        )
+
+        def func_pull_ratings(lib, opts, args):
+            self.subsonic_pull_ratings(lib)
+            self.report_requests()
 
-        subsonic_scrobble_cmd.func = func_scrobble
+        subsonic_pull_ratings_cmd.func = func_pull_ratings
 
         return [
             subsonicupdate_cmd,
             subsonicaddrating_cmd,
             subsonic_get_ids_cmd,
             subsonic_scrobble_cmd,
+            subsonic_pull_ratings_cmd,
         ]
 
-    @staticmethod
-    def __create_token():
-        """Create salt and token from given password.
+    def __format_url(self, endpoint):
+        """Get the Subsonic URL to trigger the given endpoint.
 
-        :return: The generated salt and hashed token
+        :return: Endpoint for updating Subsonic
         """
-        password = config["subsonic"]["pass"].as_str()
-
-        # Pick the random sequence and salt the password
-        r = string.ascii_letters + string.digits
-        salt = "".join([random.choice(r) for _ in range(6)])
-        salted_password = password + salt
-        token = hashlib.md5(salted_password.encode("utf-8")).hexdigest()
-
-        # Put together the payload of the request to the server and the URL
-        return salt, token
+        if self._base_url is None:
+            self._base_url = self.__base_url()
+        return self._base_url + f"/rest/{endpoint}"
 
     @staticmethod
-    def __format_url(endpoint):
-        """Get the Subsonic URL to trigger the given endpoint.
+    def __base_url():
+        """Get the Subsonic server URL.
         Uses either the url config option or the deprecated host, port,
         and context_path config options together.
-
-        :return: Endpoint for updating Subsonic
         """
-
         url = config["subsonic"]["url"].as_str()
         if url and url.endswith("/"):
             url = url[:-1]
@@ -158,85 +1779,388 @@ class SubsonicPlugin(BeetsPlugin):
             if context_path == "/":
                 context_path = ""
             url = f"http://{host}:{port}{context_path}"
-
-        return url + f"/rest/{endpoint}"
+        return url
 
     def authenticate(self):
+        """Return the authentication parameters for a request.
+
+        The returned mapping is shared and immutable; copy it into a new
+        dictionary to add request parameters.
+        """
+        with self._credentials_lock:
+            if self._credentials is None:
+                self._credentials = self.__create_credentials()
+        return self._credentials.payload()
+
+    def __create_credentials(self):
         user = config["subsonic"]["user"].as_str()
+        password = config["subsonic"]["pass"].as_str()
         auth = config["subsonic"]["auth"].as_str()
+        salt_ttl = self.config["salt_ttl"].get(int)
+
+        api_key = self.config["api_key"].as_str()
+        if api_key:
+            if self.__supports_api_key():
+                return Credentials(user, password, "apikey", api_key=api_key)
+            self._log.warning(
+                "Server does not support API key authentication, "
+                f"using {auth} authentication instead"
+            )
+        return Credentials(user, password, auth, salt_ttl)
 
-        if auth == "token":
-            salt, token = self.__create_token()
-            payload = {
-                "u": user,
-                "t": token,
-                "s": salt,
-                "v": "1.13.0",  # Subsonic 5.3 and newer
-                "c": "beets",
-                "f": "json",
-            }
-        elif auth == "password":
-            password = config["subsonic"]["pass"].as_str()
-            encpass = hexlify(password.encode()).decode()
-            payload = {
-                "u": user,
-                "p": f"enc:{encpass}",
-                "v": "1.12.0",
-                "c": "beets",
-                "f": "json",
-            }
-        else:
-            raise ValueError(f"Invalid authentication method: {auth}")
+    def __supports_api_key(self):
+        """Check whether the server advertises the OpenSubsonic
+        ``apiKeyAuthentication`` extension.
+        """
+        payload = {"v": "1.16.1", "c": "beets", "f": "json"}
+        json = self.send_request(
+            self.__format_url("getOpenSubsonicExtensions"), payload
+        )
+        if not json:
+            return False
+        extensions = json["subsonic-response"].get(
+            "openSubsonicExtensions", []
+        )
+        return any(
+            extension.get("name") == "apiKeyAuthentication"
+            for extension in extensions
+        )
+
+    def response_cache(self):
+        """Return the response cache, or None if caching is disabled."""
+        if not self.config["cache"]["enabled"].get(bool):
+            return None
+        with self._cache_lock:
+            if self._cache is None:
+                path = self.config["cache"]["path"].as_str()
+                if path:
+                    path = os.path.expanduser(path)
+                else:
+                    path = os.path.join(
+                        config.config_dir(), "subsonic_cache.db"
+                    )
+                self._cache = ResponseCache(
+                    path,
+                    self.config["cache"]["ttl"].get(int),
+                    self.config["cache"]["max_entries"].get(int),
+                )
+            return self._cache
+
+    def state_store(self):
+        """Return the store for state kept between runs."""
+        with self._state_lock:
+            if self._state is None:
+                path = self.config["state_path"].as_str()
+                if path:
+                    path = os.path.expanduser(path)
+                else:
+                    path = os.path.join(
+                        config.config_dir(), "subsonic_state.db"
+                    )
+                self._state = StateStore(path)
+            return self._state
 
-        return payload
+    def library_version(self):
+        """Return a marker of the state of the server library, or None
+        while it is being scanned or its state is unknown.
 
-    def send_request(self, url, payload):
+        The marker combines the time of the last scan and the number of
+        tracks reported by ``getScanStatus``. It is checked at most every
+        `SCAN_CHECK_INTERVAL` seconds.
+        """
+        with self._version_lock:
+            now = time.monotonic()
+            if (
+                self._version_checked is not None
+                and now - self._version_checked < self.SCAN_CHECK_INTERVAL
+            ):
+                return self._library_version
+            status = self.scan_status()
+            self._version_checked = now
+            if status is None or status.get("scanning"):
+                self._library_version = None
+            else:
+                self._library_version = (
+                    f"{status.get('lastScan', '')}:{status.get('count', '')}"
+                )
+                if self._remember_missing:
+                    self.state_store().sync_missing(self._library_version)
+            return self._library_version
+
+    def library_changed(self):
+        """Check the library version again on its next use."""
+        with self._version_lock:
+            self._version_checked = None
+
+    def _cache_key(self, url, payload):
+        """Return the cache and the key for a request, or ``(None, None)``
+        if it may not be cached.
+        """
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint not in ResponseCache.ENDPOINTS:
+            return None, None
+        cache = self.response_cache()
+        if cache is None:
+            return None, None
+        version = self.library_version()
+        if version is None:
+            return None, None
+        return cache, ResponseCache.make_key(endpoint, payload, version)
+
+    def cached_response(self, url, payload):
+        """Return the cached response for a request, if there is one."""
+        cache, key = self._cache_key(url, payload)
+        if cache is None:
+            return None
+        return cache.get(key)
+
+    def store_response(self, url, payload, json):
+        """Cache a successful response if its endpoint is cacheable."""
+        cache, key = self._cache_key(url, payload)
+        if cache is not None:
+            cache.put(key, json)
+
+    def send_request(self, url, payload, cache=True):
+        """Send a request, serving read-only endpoints from the cache.
+
+        With `cache` unset the server is always asked, e.g. for user data
+        such as ratings that change without a rescan; the fresh response
+        still replaces the cached one.
+        """
+        json = self.cached_response(url, payload) if cache else None
+        if json is not None:
+            return json
         try:
-            response = self.session.get(url, params=payload, timeout=5.0)
-            response.raise_for_status()
-            json = response.json()
+            json = self._send_request(url, payload)
+        except TransportError:
+            return None
+        if json:
+            self.store_response(url, payload, json)
+        return json
+
+    def _send_request(self, url, payload):
+        """Send a request, retrying it as its :class:`RetryPolicy` allows.
 
-            # Check if we got a valid response
-            if "subsonic-response" not in json:
+        :return: The checked response, or None if the server answered with
+            an error or an invalid response
+        :raises TransportError: If no answer was received, or the circuit
+            breaker is open
+        """
+        if not self.allow_request():
+            raise TransportError("circuit breaker open")
+
+        started = time.monotonic()
+        policy = self.retry_policy(url)
+        for attempt in range(1, policy.attempts + 1):
+            retry_after = None
+            try:
+                response = self.session.get(
+                    url, params=payload, timeout=self._timeout
+                )
+                if response.status_code not in RetryPolicy.RETRY_STATUS:
+                    response.raise_for_status()
+                    json = response.json()
+                    break
+                retry_after = response.headers.get("Retry-After")
+                error = f"HTTP {response.status_code}"
+            except requests.exceptions.Timeout as timeout_error:
+                error = timeout_error
+            except requests.exceptions.ConnectionError as connection_error:
+                error = connection_error
+            except requests.exceptions.JSONDecodeError as value_error:
+                # The server answered; only its response is unusable
+                self.record_request(True, started=started)
                 self._log.error(
-                    "Invalid response from server: missing subsonic-response"
+                    f"Invalid JSON response from server: {value_error}"
                 )
                 return None
+            except requests.exceptions.HTTPError as http_error:
+                # The server answered, and refused the request
+                self.record_request(False, http_error, started)
+                return None
+            except requests.exceptions.RequestException as request_error:
+                self.record_request(False, request_error, started)
+                raise TransportError(request_error) from request_error
+            if attempt == policy.attempts:
+                self.record_request(False, error, started)
+                raise TransportError(error)
+            delay = policy.delay(attempt, retry_after)
+            self._log.debug(f"Retrying in {delay:.1f}s after {error}")
+            time.sleep(delay)
+
+        self.record_request(True, started=started)
+        return self.check_response(json)
+
+    def retry_policy(self, url):
+        """Return the :class:`RetryPolicy` for the endpoint of `url`.
+
+        The ``retry`` options apply to all endpoints and may be
+        overridden per endpoint under ``retry.endpoints``. Requests to
+        non-idempotent endpoints are never retried: a timeout, a dropped
+        connection or a gateway error may all come after the server has
+        acted on the request, e.g. counted a play.
+        """
+        endpoint = url.rsplit("/", 1)[-1]
+        policy = self._retry_policies.get(endpoint)
+        if policy is None:
+            retry = self.config["retry"]
+            options = {
+                "attempts": retry["attempts"].get(int),
+                "backoff": retry["backoff"].as_number(),
+                "max_backoff": retry["max_backoff"].as_number(),
+            }
+            if endpoint in retry["endpoints"].keys():
+                options.update(retry["endpoints"][endpoint].get(dict))
+            if endpoint in self.NON_IDEMPOTENT:
+                options["attempts"] = 1
+            policy = RetryPolicy(**options)
+            self._retry_policies[endpoint] = policy
+        return policy
+
+    def allow_request(self):
+        """Check the circuit breaker before sending a request."""
+        if self.breaker.allow():
+            return True
+        self.request_stats.add("aborted")
+        return False
+
+    def record_request(self, success, error=None, started=None):
+        """Record the outcome of a request that reached the network.
+
+        `started` is the :func:`time.monotonic` time the request was
+        first sent, used to feed its latency to the concurrency
+        controller.
+        """
+        if started is not None:
+            self.concurrency.record(time.monotonic() - started, success)
+        if success:
+            self.request_stats.add("completed")
+        else:
+            self.request_stats.add("failed")
+            self._log.error(f"Request to {self.data_source} failed: {error}")
+        if self.breaker.record(success):
+            self._log.error(
+                f"{self.data_source} is not responding; pausing requests "
+                f"for {self.breaker.cooldown} seconds"
+            )
 
-            if json["subsonic-response"]["status"] == "ok":
-                return json
-            else:
-                error = json["subsonic-response"].get("error", {})
-                error_message = error.get("message", "Unknown error")
-                error_code = error.get("code", "Unknown code")
-                if str(error_code) == "70":
-                    self._log.warning(
-                        f"Server returned error 70 (data not found): {error_message}"
-                    )
-                    return None
-                self._log.error(
-                    f"Server returned error {error_code}: {error_message}"
+    def report_requests(self):
+        """Log the request counts of a bulk command."""
+        self._log.info(f"Requests: {self.request_stats}")
+
+    def check_response(self, json):
+        """Return `json` if it is a successful Subsonic response, else
+        log the server error and return None.
+        """
+        # Check if we got a valid response
+        if "subsonic-response" not in json:
+            self._log.error(
+                "Invalid response from server: missing subsonic-response"
+            )
+            return None
+
+        if json["subsonic-response"]["status"] == "ok":
+            return json
+        else:
+            error = json["subsonic-response"].get("error", {})
+            error_message = error.get("message", "Unknown error")
+            error_code = error.get("code", "Unknown code")
+            if str(error_code) == "70":
+                self._log.warning(
+                    f"Server returned error 70 (data not found): {error_message}"
                 )
                 return None
-        except requests.exceptions.RequestException as error:
             self._log.error(
-                f"RequestException occurred while sending request: {error}"
+                f"Server returned error {error_code}: {error_message}"
             )
             return None
-        except ValueError as error:
-            self._log.error(f"Invalid JSON response from server: {error}")
+
+    def run_flow(self, steps):
+        """Run a request flow to completion with blocking requests.
+
+        A request flow is a generator that yields ``(url, payload)``
+        pairs, receives the response of :meth:`send_request` for each,
+        and returns its result. Writing the request logic this way lets
+        the same code run on worker threads or on the async engine.
+        """
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(self.send_request(*request))
+        except StopIteration as stop:
+            return stop.value
+
+    def async_engine(self):
+        """Return an :class:`AsyncEngine` if the async engine is
+        configured and available, else None.
+        """
+        if self.config["engine"].as_choice(["threads", "async"]) != "async":
+            return None
+        if aiohttp is None:
+            self._log.warning(
+                "The async engine requires aiohttp; falling back to threads"
+            )
             return None
+        return AsyncEngine(
+            self,
+            self.config["concurrency"].get(int),
+            self._timeout,
+        )
 
     def close(self):
         self.session.close()
+        if self._cache is not None:
+            self._cache.close()
+        if self._state is not None:
+            self._state.close()
+
+    def scan_lock(self):
+        return ScanLock(
+            os.path.join(config.config_dir(), "subsonic_scan.lock"),
+            self.config["scan_debounce"].as_number(),
+        )
 
-    def start_scan(self):
-        """Start a scan of the Subsonic library."""
+    def start_scan(self, changed_at=None):
+        """Start a scan of the Subsonic library.
+
+        With `changed_at`, the time this process last changed the library,
+        the scan is skipped if a beets process started one since then, as
+        it includes the changes. A scan started before that time delays
+        this one until `scan_debounce` seconds after it.
+
+        :return: Whether this process started a scan
+        """
+        while True:
+            with self.scan_lock().hold() as lock:
+                delay = 0
+                if changed_at is not None:
+                    if lock.last_scan() >= changed_at:
+                        self._log.info(
+                            "Subsonic scan started since the last change; "
+                            "skipping"
+                        )
+                        return False
+                    delay = lock.remaining()
+                if not delay:
+                    if not self._start_scan():
+                        return False
+                    lock.mark()
+                    return True
+            self._log.info(
+                f"Subsonic scan started recently; scanning in {delay:.0f}s"
+            )
+            time.sleep(delay)
+
+    def _start_scan(self):
+        """Ask the server to scan its library.
+
+        :return: Whether a scan was started
+        """
         try:
             payload = self.authenticate()
         except ValueError as e:
             self._log.error(f"Authentication failed: {e}")
-            return
+            return False
 
         # get scan status
         url = self.__format_url("getScanStatus")
@@ -245,7 +2169,7 @@ class SubsonicPlugin(BeetsPlugin):
         json = self.send_request(url, payload)
         if json and json["subsonic-response"]["scanStatus"]["scanning"]:
             self._log.info("Subsonic is currently scanning")
-            return
+            return False
 
         url = self.__format_url("startScan")
         self._log.debug("URL is {0}", url)
@@ -254,26 +2178,484 @@ class SubsonicPlugin(BeetsPlugin):
         if json:
             count = json["subsonic-response"]["scanStatus"]["count"]
             self._log.info(f"Updating Subsonic; scanning {count} tracks")
+            self.library_changed()
+            return True
+        return False
+
+    def scan_status(self):
+        """Return the ``scanStatus`` of the server, or None on failure."""
+        try:
+            payload = self.authenticate()
+        except ValueError as e:
+            self._log.error(f"Authentication failed: {e}")
+            return None
+        json = self.send_request(self.__format_url("getScanStatus"), payload)
+        if not json:
+            return None
+        return json["subsonic-response"].get("scanStatus")
+
+    def wait_for_scan(self, timeout=None, resolve=False):
+        """Poll the server until its scan completes.
+
+        The polling interval grows from `SCAN_POLL` to `SCAN_MAX_POLL`
+        seconds while the scan runs. On completion, the ids of newly
+        imported items are resolved if `resolve` is set, and the
+        ``subsonic_scan_complete`` event is sent with the number of
+        scanned tracks.
+
+        :return: Whether the scan completed within `timeout` seconds
+        """
+        started = time.monotonic()
+        interval = self.SCAN_POLL
+        failures = 0
+        last = None
+        while True:
+            status = self.scan_status()
+            elapsed = time.monotonic() - started
+            if status is None:
+                failures += 1
+                if failures >= 3:
+                    self._log.error("Could not get the Subsonic scan status")
+                    return False
+            else:
+                failures = 0
+                count = status.get("count", 0)
+                if not status.get("scanning"):
+                    break
+                message = f"Subsonic is scanning: {count} tracks"
+                if last is not None:
+                    rate = (count - last[0]) / (elapsed - last[1])
+                    message += f" ({rate:.1f}/s)"
+                self._log.info(message)
+                last = count, elapsed
+            if timeout is not None and elapsed + interval > timeout:
+                self._log.warning(
+                    f"Subsonic scan still running after {elapsed:.0f}s"
+                )
+                return False
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.SCAN_MAX_POLL)
+
+        self._log.info(
+            f"Subsonic scan complete: {count} tracks in {elapsed:.0f}s"
+        )
+        self.library_changed()
+        if resolve:
+            self.resolve_imported()
+        plugins.send("subsonic_scan_complete", count=count)
+        return True
+
+    def fetch_catalog(self, cache=True):
+        """Page through the whole song catalog of the Subsonic server.
+
+        Uses ``search3`` with an empty query first. Servers that do not
+        answer empty queries are walked album by album through
+        ``getAlbumList2`` and ``getAlbum`` instead. Unset `cache` when the
+        user data of the songs (rating, starred, play count) must be
+        current.
+
+        :return: A generator of Subsonic song dictionaries
+        """
+        payload = self.authenticate()
+        page_size = self.config["catalog_page_size"].get(int)
+
+        url = self.__format_url("search3")
+        offset = 0
+        songs = []
+        while True:
+            page_payload = {
+                **payload,
+                "query": "",
+                "artistCount": 0,
+                "albumCount": 0,
+                "songCount": page_size,
+                "songOffset": offset,
+            }
+            json = self.send_request(url, page_payload, cache)
+            if not json:
+                break
+            search_result = json["subsonic-response"].get("searchResult3", {})
+            songs = search_result.get("song", [])
+            yield from songs
+            if len(songs) < page_size:
+                break
+            offset += len(songs)
+
+        if offset == 0 and not songs:
+            self._log.debug(
+                "Empty search3 query not supported, walking albums instead"
+            )
+            yield from self._fetch_catalog_by_album(payload, page_size, cache)
+
+    def _fetch_catalog_by_album(self, payload, page_size, cache=True):
+        """Walk the catalog through ``getAlbumList2`` and ``getAlbum``."""
+        list_url = self.__format_url("getAlbumList2")
+        album_url = self.__format_url("getAlbum")
+        offset = 0
+        while True:
+            list_payload = {
+                **payload,
+                "type": "alphabeticalByName",
+                "size": page_size,
+                "offset": offset,
+            }
+            json = self.send_request(list_url, list_payload, cache)
+            if not json:
+                return
+            album_list = json["subsonic-response"].get("albumList2", {})
+            albums = album_list.get("album", [])
+            for album in albums:
+                json = self.send_request(
+                    album_url, {**payload, "id": album["id"]}, cache
+                )
+                if json:
+                    album = json["subsonic-response"].get("album", {})
+                    yield from album.get("song", [])
+            if len(albums) < page_size:
+                return
+            offset += len(albums)
+
+    def build_catalog_index(self, cache=True):
+        """Build a :class:`CatalogIndex` from a full catalog snapshot."""
+        index = CatalogIndex(
+            self.config["path_prefix"]["server"].as_str(), self.matcher
+        )
+        for song in tqdm(self.fetch_catalog(cache), desc="Fetching catalog"):
+            index.add(song)
+        self._log.info(f"Indexed {len(index)} songs from {self.data_source}")
+        return index
+
+    def subsonic_get_ids(
+        self,
+        items,
+        force,
+        catalog=False,
+        workers=None,
+        albums=False,
+        journal=None,
+        paths=False,
+    ):
+        """Get subsonic_id for items
+
+        Items recorded in `journal` are skipped. Items are added to it once
+        their song was found, or once every search for it was answered
+        without a match.
+        """
+        if catalog or paths:
+            self._get_ids_from_catalog(items, force, paths, journal)
+            return
+
+        def needs_id(item):
+            if not force and item.get("subsonic_id"):
+                self._log.debug("subsonic_id already present for: {}", item)
+                return False
+            if journal is not None and item.id in journal:
+                self._log.debug("Already looked up in this run: {}", item)
+                return False
+            return True
+
+        if albums:
+            pending = list(filter(needs_id, items))
+            pending = self._get_ids_by_album(pending, workers, journal)
+        else:
+            # Filter lazily so that items can be streamed from the library
+            pending = filter(needs_id, items)
+
+        attempted = 0
+        with self.item_writer(journal) as writer, tqdm(
+            total=len(pending) if albums else len(items)
+        ) as progress:
+
+            def store(item, result):
+                nonlocal attempted
+                attempted += 1
+                progress.update()
+                song_id, settled = result or (None, False)
+                if song_id is not None:
+                    item.subsonic_id = song_id
+                    writer.put(item)
+                elif settled and journal is not None:
+                    journal.add(item.id)
+
+            engine = self.async_engine()
+            if engine is not None:
+                engine.run(
+                    pending,
+                    lambda item: self._lookup_flow(item, force),
+                    store,
+                )
+            else:
+                results = self.pipeline(
+                    pending,
+                    lambda item: self.run_flow(self._lookup_flow(item, force)),
+                    workers,
+                )
+                for item, song_id in results:
+                    store(item, song_id)
+        self._log.info(
+            f"Stored subsonic_id for {writer.stored} of {attempted} items"
+        )
+
+    def journal(self, resume, command, *args):
+        """Return the :class:`Journal` of a bulk command run, identified
+        by the command name and its arguments.
+        """
+        run = " ".join([command, *map(str, args)])
+        return Journal(self.state_store(), run, resume)
+
+    @contextmanager
+    def resumable(self, journal):
+        """Keep the journal of an interrupted run and drop it once the
+        run completes.
+        """
+        try:
+            yield journal
+        except BaseException:
+            journal.flush()
+            self._log.info(
+                "Run interrupted; use --resume to continue where it stopped"
+            )
+            raise
+        journal.finish()
+
+    def item_writer(self, journal=None):
+        """Return an :class:`ItemWriter` using the configured batch size.
+
+        Stored items are added to `journal` once their transaction has
+        been committed, so that a resumed run never skips an item whose
+        subsonic_id was lost.
+        """
+        on_commit = None
+        if journal is not None:
+
+            def on_commit(items):
+                journal.add(*(item.id for item in items))
+
+        return ItemWriter(
+            self._log,
+            self.config["write_batch_size"].get(int),
+            on_commit=on_commit,
+        )
+
+    def size_connection_pool(self, workers):
+        """Keep one pooled HTTP connection per possible worker thread, so
+        that urllib3 does not discard connections.
+        """
+        if workers <= self._pool_size:
+            return
+        self._pool_size = workers
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def pipeline(self, items, func, workers=None):
+        """Run `func` over `items` on a pool of worker threads.
+
+        With a fixed number of `workers`, that many calls are in flight
+        at any time. Otherwise the number follows the limit of the
+        adaptive concurrency controller. Results are yielded as
+        ``(item, result)`` pairs in completion order rather than
+        submission order.
+        """
+        if workers:
+            pool_size = workers
+            self.size_connection_pool(workers)
+        else:
+            pool_size = self.concurrency.maximum
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            try:
+                for item in items:
+                    in_flight[executor.submit(func, item)] = item
+                    while len(in_flight) >= (
+                        workers or self.concurrency.limit
+                    ):
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield in_flight.pop(future), future.result()
+                for future in as_completed(in_flight):
+                    yield in_flight[future], future.result()
+            except BaseException:
+                # On Ctrl-C or when the consumer stops early, drop the
+                # queued calls instead of waiting for all of them.
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    def _get_ids_by_album(self, items, workers, journal=None):
+        """Resolve subsonic_id for items grouped by their beets album.
+
+        Each album costs one ``search3`` and one ``getAlbum`` request.
+        Items are stored as they are matched.
+
+        :return: The items that still need a per-item lookup
+        """
+        groups = {}
+        leftover = []
+        for item in items:
+            if not item.album:
+                leftover.append(item)
+                continue
+            artist = item.albumartist or item.artist
+            key = item.album_id or (artist, item.album)
+            groups.setdefault(key, []).append(item)
+
+        with self.item_writer(journal) as writer:
+            results = self.pipeline(
+                groups.values(), self.get_album_songs, workers
+            )
+            for group, songs in tqdm(
+                results, total=len(groups), desc="Albums"
+            ):
+                candidates = [MatchKeys.for_song(song) for song in songs or []]
+                for item in group:
+                    song_id = _match_album_track(
+                        item, candidates, self.matcher
+                    )
+                    if song_id is None:
+                        leftover.append(item)
+                        continue
+                    item.subsonic_id = song_id
+                    writer.put(item)
+        self._log.info(
+            f"Matched {writer.stored} items by album, "
+            f"{len(leftover)} left for individual search"
+        )
+        return leftover
+
+    def get_album_songs(self, items):
+        """Fetch the Subsonic tracklist of the album `items` belong to.
+
+        :return: A list of Subsonic song dictionaries, or None
+        """
+        item = items[0]
+        artist = item.albumartist or item.artist
+        payload = self.authenticate()
+        search_payload = {
+            **payload,
+            "query": f"{artist} {item.album}",
+            "artistCount": 0,
+            "albumCount": 10,
+            "songCount": 0,
+        }
+        json = self.send_request(self.__format_url("search3"), search_payload)
+        if not json:
+            return None
+        search_result = json["subsonic-response"].get("searchResult3", {})
+        candidates = [
+            album
+            for album in search_result.get("album", [])
+            if _normalize(album.get("name")) == _normalize(item.album)
+        ]
+        if not candidates:
+            self._log.debug(f"No album found for: {artist} - {item.album}")
+            return None
+        # Prefer the album by the same artist, if there are several.
+        artist_key = _normalize(artist)
+        candidates.sort(
+            key=lambda album: _normalize(album.get("artist")) != artist_key
+        )
+
+        album_payload = {**payload, "id": candidates[0]["id"]}
+        json = self.send_request(self.__format_url("getAlbum"), album_payload)
+        if not json:
+            return None
+        return json["subsonic-response"].get("album", {}).get("song", [])
+
+    def _music_folder(self):
+        """Return the local path of the music folder shared with the
+        server.
+        """
+        prefix = self.config["path_prefix"]["local"].as_str()
+        if not prefix:
+            prefix = config["directory"].as_str()
+        return os.path.expanduser(prefix)
+
+    @staticmethod
+    def _relative_path(item, folder):
+        """Return the path of `item` relative to the music `folder`, or
+        None if it lies outside of it.
+        """
+        try:
+            path = os.path.relpath(os.fsdecode(item.path), folder)
+        except ValueError:  # On another drive
+            return None
+        if path == os.pardir or path.startswith(os.pardir + os.sep):
+            return None
+        return path
 
-    def subsonic_get_ids(self, items, force):
-        """Get subsonic_id for items"""
-        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+    def _get_ids_from_catalog(self, items, force, paths=False, journal=None):
+        """Resolve subsonic_id for items from a catalog snapshot.
+
+        With `paths`, items are first matched by their path relative to
+        the music folder. Matched items are added to `journal`; unmatched
+        ones are cheap to try again.
+        """
+        index = self.build_catalog_index()
+        folder = self._music_folder() if paths else None
+        unmatched = 0
+        with self.item_writer(journal) as writer:
             for item in tqdm(items, total=len(items)):
-                if not force and hasattr(item, "subsonic_id"):
-                    self._log.debug("subsonic_id already present for: {}", item)
+                if not force and item.get("subsonic_id"):
+                    self._log.debug(
+                        "subsonic_id already present for: {}", item
+                    )
                     continue
-                future = executor.submit(self.get_song_id, item)
-                item.subsonic_id = future.result()
-                item.store()
+                if journal is not None and item.id in journal:
+                    self._log.debug("Already matched in this run: {}", item)
+                    continue
+                song_id = None
+                if paths:
+                    path = self._relative_path(item, folder)
+                    if path is not None:
+                        song_id = index.lookup_path(path)
+                if song_id is None:
+                    song_id = index.lookup(item)
+                if song_id is None:
+                    self._log.debug("No catalog match for: {}", item)
+                    unmatched += 1
+                    continue
+                item.subsonic_id = song_id
+                writer.put(item)
+        if unmatched:
+            self._log.warning(
+                f"{unmatched} items could not be matched against the catalog"
+            )
 
-    def get_song_id(self, item):
+    def get_song_id(self, item, force=False):
         """
         Retrieves the ID of a song from the Subsonic server using multiple search strategies.
+
+        Items that were not found before are skipped until their metadata
+        changes or the server is rescanned, unless `force` is set.
+        """
+        return self.run_flow(self._song_id_flow(item, force))
+
+    def _song_id_flow(self, item, force=False):
+        """Request flow behind :meth:`get_song_id`."""
+        song_id, _ = yield from self._lookup_flow(item, force)
+        return song_id
+
+    def _lookup_flow(self, item, force=False):
+        """Look up the Subsonic id of `item`.
+
+        :return: The song id or None, and whether the outcome is settled:
+            the song was found, or every search completed without a match
         """
+        # Missing items are only remembered against a stable library
+        remember_missing = (
+            self._remember_missing and self.library_version() is not None
+        )
+        if remember_missing and not force:
+            fingerprint = _fingerprint(item)
+            if self.state_store().is_missing(item.id, fingerprint):
+                self._log.debug(f"Skipping known missing item: {item}")
+                return None, True
+
         url = self.__format_url("search3")
         payload = self.authenticate()
         if payload is None:
-            return None
+            return None, False
+        item_keys = MatchKeys.for_item(item)
 
         # Try different search strategies in order of specificity
         search_strategies = [
@@ -284,14 +2666,17 @@ class SubsonicPlugin(BeetsPlugin):
             lambda: f"{item.artist} {item.album}",  # new fallback
         ]
 
+        # Only remember the item as missing if every search got an answer
+        complete = True
         for strategy in search_strategies:
             query = strategy()
             self._log.debug(f"Trying search query: {query}")
 
             search_payload = {**payload, "query": query, "songCount": 10}
-            json = self.send_request(url, search_payload)
+            json = yield url, search_payload
 
             if not json:
+                complete = False
                 continue
 
             search_result = json["subsonic-response"].get("searchResult3", {})
@@ -299,26 +2684,48 @@ class SubsonicPlugin(BeetsPlugin):
                 self._log.debug(f"No results found for query: {query}")
                 continue
 
-            # Try to find the best match among results
-            for song in search_result["song"]:
-                # Check if title matches (case-insensitive)
-                if item.title.lower() in song["title"].lower():
-                    self._log.debug(
-                        f"Match found:\n"
-                        f"Beets:    {item.artist} - {item.title}\n"
-                        f"Subsonic: {song['artist']} - {song['title']}"
-                    )
-                    return song["id"]
+            # Try to find the best match among results, preferring the
+            # song with the same MusicBrainz recording id
+            songs = search_result["song"]
+            match = None
+            if item.mb_trackid:
+                match = next(
+                    (
+                        song
+                        for song in songs
+                        if song.get("musicBrainzId") == item.mb_trackid
+                    ),
+                    None,
+                )
+            if match is None:
+                match = self.matcher.best(
+                    item_keys, [MatchKeys.for_song(song) for song in songs]
+                )
+                match = None if match is None else match.source
+            if match is not None:
+                self._log.debug(
+                    f"Match found:\n"
+                    f"Beets:    {item.artist} - {item.title}\n"
+                    f"Subsonic: {match['artist']} - {match['title']}"
+                )
+                if remember_missing and force:
+                    self.state_store().forget_missing(item.id)
+                return match["id"], True
 
+        if not complete:
+            self._log.debug(f"Lookup for {item} did not complete")
+            return None, False
         self._log.warning(
             f"Could not find match (even with album) for:\n"
             f"Title: {item.title}\n"
             f"Artist: {item.artist}\n"
             f"Album: {item.album}"
         )
-        return None
+        if remember_missing:
+            self.state_store().add_missing(item.id, _fingerprint(item))
+        return None, True
 
-    def update_rating(self, item, url, payload, rating_field):
+    def update_rating(self, item, url, payload, rating_field, force=False):
         """
         Update the rating of an item on the Subsonic server.
 
@@ -326,35 +2733,48 @@ class SubsonicPlugin(BeetsPlugin):
             item: The item to update the rating for.
             url: The URL of the Subsonic server.
             payload: Additional parameters to include in the request.
+            force: Send the rating even if it was already pushed.
 
         Returns:
-            None
+            Whether the item is done with: its rating was sent, or there
+            is nothing to send. False if a request failed.
 
         Raises:
             None
         """
+        return self.run_flow(
+            self._rating_flow(item, url, payload, rating_field, force)
+        )
+
+    def _rating_flow(self, item, url, payload, rating_field, force=False):
+        """Request flow behind :meth:`update_rating`."""
         id = getattr(item, "subsonic_id", None)
         if id is None:
             self._log.debug(
                 f"No subsonic_id found for {item}, attempting to fetch it"
             )
-            id = self.get_song_id(item)
+            id, settled = yield from self._lookup_flow(item)
             if id is None:
                 self._log.error(
                     f"Could not find song ID for {item}, skipping rating update"
                 )
-                return
+                return settled
 
         try:
             rating = getattr(item, rating_field)
         except AttributeError:
             self._log.debug(f"No {rating_field} found for: {item}")
-            return
+            return True
 
         rating = self.transform_rating(rating, rating_field)
         if rating is None:
             self._log.error(f"Invalid rating value for {item}")
-            return
+            return True
+
+        ledger = self.state_store()
+        if not force and ledger.pushed_rating(id, rating_field) == rating:
+            self._log.debug(f"Rating for {item} is unchanged: {rating}")
+            return True
 
         request_payload = payload.copy()
         request_payload.update(
@@ -365,11 +2785,13 @@ class SubsonicPlugin(BeetsPlugin):
         )
 
         self._log.debug(f"Updating rating for {item} (ID: {id}) to {rating}")
-        json = self.send_request(url, request_payload)
+        json = yield url, request_payload
         if json:
             self._log.debug(f"Successfully updated rating for {item}: {rating}")
-        else:
-            self._log.error(f"Failed to update rating for {item}")
+            ledger.add_pushed_rating(id, rating_field, rating)
+            return True
+        self._log.error(f"Failed to update rating for {item}")
+        return False
 
     def transform_rating(self, rating, rating_field):
         """Transform rating from beets to subsonic rating"""
@@ -392,34 +2814,246 @@ class SubsonicPlugin(BeetsPlugin):
         else:
             return int(rating)
 
-    def subsonic_add_rating(self, items, rating_field):
+    def subsonic_add_rating(
+        self, items, rating_field, diff=False, force=False, journal=None
+    ):
         url = self.__format_url("setRating")
         payload = self.authenticate()
         if payload is None:
             return
 
-        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
-            list(
-                tqdm(
-                    executor.map(
-                        lambda item: self.update_rating(
-                            item, url, payload, rating_field
-                        ),
-                        items,
+        if journal is not None and journal.done:
+            items = [item for item in items if item.id not in journal]
+        if diff:
+            items = self._changed_ratings(items, rating_field)
+            # Server state has been compared already; the push ledger
+            # could hide ratings that were changed on the server.
+            force = True
+
+        with tqdm(total=len(items)) as progress:
+
+            def done(item, result):
+                progress.update()
+                if result and journal is not None:
+                    journal.add(item.id)
+
+            engine = self.async_engine()
+            if engine is not None:
+                engine.run(
+                    items,
+                    lambda item: self._rating_flow(
+                        item, url, payload, rating_field, force
                     ),
-                    total=len(items),
+                    done,
                 )
+                return
+
+            results = self.pipeline(
+                items,
+                lambda item: self.update_rating(
+                    item, url, payload, rating_field, force
+                ),
+            )
+            for item, result in results:
+                done(item, result)
+
+    def _changed_ratings(self, items, rating_field):
+        """Select the items whose rating differs from the server's.
+
+        Server ratings are read from a live catalog snapshot, bypassing
+        the response cache. Items without a subsonic_id are matched
+        against the snapshot by MusicBrainz id or match keys only, as a
+        fuzzy match could push the rating to another song; those that
+        cannot be matched are kept so that they are searched for.
+        """
+        index = self.build_catalog_index(cache=False)
+        changed = []
+        for item in items:
+            value = item.get(rating_field)
+            if value is None:
+                continue
+            song_id = item.get("subsonic_id") or index.lookup(
+                item, fuzzy=False
             )
+            song = index.get(song_id)
+            if song is not None:
+                rating = self.transform_rating(value, rating_field)
+                if song.get("userRating", 0) == rating:
+                    continue
+                item.subsonic_id = song_id
+            changed.append(item)
+        self._log.info(
+            f"{len(changed)} of {len(items)} ratings differ from "
+            f"{self.data_source}"
+        )
+        return changed
+
+    def subsonic_pull_ratings(self, lib):
+        """Import userRating, starred and playCount from the server.
+
+        The catalog is streamed page by page, bypassing the response
+        cache, and mapped to items through their stored subsonic_id. Only
+        changed values are written, in batched transactions, without
+        requesting a scan of the server library.
+        """
+        fields = list(self.item_types)
+        with lib.transaction() as tx:
+            song_items = {
+                row["value"]: row["entity_id"]
+                for row in tx.query(
+                    "SELECT entity_id, value FROM item_attributes "
+                    "WHERE key = 'subsonic_id'"
+                )
+            }
+            current = {}
+            for row in tx.query(
+                "SELECT entity_id, key, value FROM item_attributes "
+                f"WHERE key IN ({', '.join('?' * len(fields))})",
+                fields,
+            ):
+                value = self.item_types[row["key"]].from_sql(row["value"])
+                current.setdefault(row["entity_id"], {})[row["key"]] = value
+
+        changes = []
+        updated = 0
+        batch_size = self.config["write_batch_size"].get(int)
+        songs = self.fetch_catalog(cache=False)
+        for song in tqdm(songs, desc="Fetching catalog"):
+            item_id = song_items.get(song["id"])
+            if item_id is None:
+                continue
+            values = {
+                "subsonic_userrating": song.get("userRating", 0),
+                "subsonic_starred": "starred" in song,
+                "subsonic_playcount": song.get("playCount", 0),
+            }
+            if values == current.get(item_id):
+                continue
+            changes.append((item_id, values))
+            if len(changes) >= batch_size:
+                updated += self._write_pulled_values(lib, changes)
+                changes = []
+        updated += self._write_pulled_values(lib, changes)
+        self._log.info(
+            f"Updated {updated} of {len(song_items)} items "
+            f"from {self.data_source}"
+        )
+
+    def _write_pulled_values(self, lib, changes):
+        """Store a batch of pulled values in a single transaction."""
+        updated = 0
+        with self.scan_suppressed(), lib.transaction():
+            for item_id, values in changes:
+                item = lib.get_item(item_id)
+                if item is None:
+                    continue
+                item.update(values)
+                item.store()
+                updated += 1
+        return updated
 
-    def subsonic_scrobble(self, items):
+    def subsonic_scrobble(self, items, batch_size=None, force=False):
         url = self.__format_url("scrobble")
         payload = self.authenticate()
         if payload is None:
             return
 
+        if not force:
+            scrobbled = self.state_store().scrobbled()
+            new_items = []
+            for item in items:
+                played = item.get("plex_lastviewedat")
+                if played is None or (item.id, int(played)) not in scrobbled:
+                    new_items.append(item)
+            self._log.info(
+                f"Skipping {len(items) - len(new_items)} plays "
+                "that were already scrobbled"
+            )
+            items = new_items
+
+        if batch_size is None:
+            batch_size = self.config["scrobble_batch_size"].get(int)
+        if batch_size > 1:
+            self._scrobble_batched(items, url, payload, batch_size)
+            return
+
+        engine = self.async_engine()
+        if engine is not None:
+            with tqdm(total=len(items)) as progress:
+                engine.run(
+                    items,
+                    lambda item: self._scrobble_flow(item, url, payload),
+                    lambda item, result: progress.update(),
+                )
+            return
+
         for item in tqdm(items, total=len(items)):
             self.scrobble(item, url, payload)
 
+    def _scrobble_batched(self, items, url, payload, batch_size):
+        """Scrobble items in chronological order, sending `batch_size`
+        plays per request through repeated ``id`` and ``time``
+        parameters.
+
+        If the server answers a batch with an error, that batch and all
+        remaining plays are sent one by one instead. Batches that fail in
+        transit are not resent, since the server may have recorded them.
+        """
+        plays = []
+        unresolved = []
+        for item in items:
+            played = item.get("plex_lastviewedat")
+            if played is None:
+                self._log.debug("No scrobble time found for: {}", item)
+            elif item.get("subsonic_id") is None:
+                unresolved.append(item)
+            else:
+                plays.append((int(played) * 1000, item.subsonic_id, item))
+
+        for item, song_id in self.pipeline(unresolved, self.get_song_id):
+            if song_id is None:
+                self._log.error(f"Could not find song ID for {item}")
+                continue
+            plays.append((int(item.plex_lastviewedat) * 1000, song_id, item))
+        plays.sort(key=lambda play: play[0])
+
+        batched = True
+        for start in tqdm(range(0, len(plays), batch_size)):
+            batch = plays[start : start + batch_size]
+            if batched:
+                params = list(payload.items())
+                for played, song_id, _ in batch:
+                    params += [("id", song_id), ("time", played)]
+
+                try:
+                    json = self._send_request(url, params)
+                except TransportError:
+                    self._log.error(f"Error scrobbling {len(batch)} plays")
+                    continue
+                if json:
+                    self._log.debug(f"Scrobbled {len(batch)} plays")
+                    self.state_store().add_scrobbles(
+                        (item.id, played // 1000) for played, _, item in batch
+                    )
+                    continue
+                self._log.warning(
+                    "Server rejected batched scrobbles, "
+                    "sending plays one by one"
+                )
+                batched = False
+
+            for played, song_id, item in batch:
+                json = self.send_request(
+                    url, {**payload, "id": song_id, "time": played}
+                )
+                if json:
+                    self._log.debug(f"Scrobbled {item}")
+                    self.state_store().add_scrobbles(
+                        [(item.id, played // 1000)]
+                    )
+                else:
+                    self._log.error(f"Error scrobbling {item}")
+
     def scrobble(self, item, url, payload):
         """
         Scrobble an item to the Subsonic server.
@@ -435,9 +3069,15 @@ class SubsonicPlugin(BeetsPlugin):
         Raises:
             None
         """
+        self.run_flow(self._scrobble_flow(item, url, payload))
 
+    def _scrobble_flow(self, item, url, payload):
+        """Request flow behind :meth:`scrobble`."""
         if not hasattr(item, "subsonic_id"):
-            id = self.get_song_id(item)
+            id = yield from self._song_id_flow(item)
+            if id is None:
+                self._log.error(f"Could not find song ID for {item}")
+                return
         else:
             id = item.subsonic_id
         try:
@@ -450,8 +3090,11 @@ class SubsonicPlugin(BeetsPlugin):
         except AttributeError:
             self._log.debug("No scrobble time found for: {}", item)
             return
-        json = self.send_request(url, payload)
+        json = yield url, payload
         if json:
             self._log.debug(f"Scrobbled {item}")
+            self.state_store().add_scrobbles(
+                [(item.id, int(item.plex_lastviewedat))]
+            )
         else:
             self._log.error("Error scrobbling")
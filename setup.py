@@ -16,4 +16,7 @@ setup(
         'requests',
         'tqdm'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
 )
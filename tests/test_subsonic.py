@@ -0,0 +1,743 @@
+"""Tests for the subsonic plugin."""
+
+import sqlite3
+
+import pytest
+import requests
+from beets import config
+from beets.dbcore import query
+from beets.library import Item, Library, parse_query_parts
+
+from beetsplug import subsonic
+from beetsplug.subsonic import (
+    CatalogIndex,
+    CircuitBreaker,
+    ItemStream,
+    Journal,
+    MatchKeys,
+    MissingFlexQuery,
+    ResponseCache,
+    RetryPolicy,
+    SongMatcher,
+    SubsonicPlugin,
+    _match_album_track,
+    _match_key,
+)
+
+
+class Clock:
+    """Stand-in for :func:`time.time` and :func:`time.monotonic`."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(subsonic.time, "time", clock)
+    monkeypatch.setattr(subsonic.time, "monotonic", clock)
+    return clock
+
+
+class Response:
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.headers = {}
+        self._body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"HTTP {self.status_code}")
+
+    def json(self):
+        return self._body
+
+
+class FakeServer:
+    """Answer the plugin's requests in place of its HTTP session.
+
+    Each endpoint is a method receiving the request parameters as a list
+    of pairs and returning the body of a successful response, or None to
+    answer with an error. Statuses queued in `statuses` are returned
+    before any endpoint is asked.
+    """
+
+    def __init__(self):
+        self.songs = []
+        self.scrobbles = []
+        self.requests = []
+        self.statuses = []
+        self.reject_batches = False
+
+    def get(self, url, params=None, timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        if isinstance(params, dict):
+            params = list(params.items())
+        self.requests.append((endpoint, params))
+        if self.statuses:
+            status = self.statuses.pop(0)
+            if isinstance(status, Exception):
+                raise status
+            return Response({}, status)
+        body = getattr(self, endpoint)(params)
+        if body is None:
+            error = {"code": 0, "message": "rejected"}
+            return Response(
+                {"subsonic-response": {"status": "failed", "error": error}}
+            )
+        return Response({"subsonic-response": {"status": "ok", **body}})
+
+    def close(self):
+        pass
+
+    def endpoint_requests(self, endpoint):
+        return [params for name, params in self.requests if name == endpoint]
+
+    def getScanStatus(self, params):
+        count = len(self.songs)
+        return {"scanStatus": {"scanning": False, "count": count}}
+
+    def search3(self, params):
+        params = dict(params)
+        offset = int(params.get("songOffset", 0))
+        page = self.songs[offset : offset + int(params["songCount"])]
+        return {"searchResult3": {"song": page}}
+
+    def scrobble(self, params):
+        ids = [value for key, value in params if key == "id"]
+        times = [int(value) for key, value in params if key == "time"]
+        if len(ids) > 1 and self.reject_batches:
+            return None
+        self.scrobbles.extend(zip(ids, times))
+        return {}
+
+
+@pytest.fixture
+def lib(tmp_path):
+    return Library(str(tmp_path / "library.db"))
+
+
+@pytest.fixture
+def server():
+    return FakeServer()
+
+
+@pytest.fixture
+def plugin(tmp_path, server):
+    config["subsonic"].set(
+        {
+            "auth": "token",
+            "engine": "threads",
+            "state_path": str(tmp_path / "state.db"),
+            "cache": {"enabled": False},
+            "retry": {"attempts": 3, "backoff": 0, "endpoints": {}},
+            "scrobble_batch_size": 1,
+        }
+    )
+    plugin = SubsonicPlugin()
+    plugin.session = server
+    yield plugin
+    plugin.close()
+
+
+def song(id, title, artist="Band", album="Record", **fields):
+    return {
+        "id": id,
+        "title": title,
+        "artist": artist,
+        "album": album,
+        "duration": 200,
+        "track": 1,
+        **fields,
+    }
+
+
+def item(title, artist="Band", album="Record", **fields):
+    values = {"length": 200.4, "track": 1, "disc": 1, **fields}
+    return Item(title=title, artist=artist, album=album, **values)
+
+
+@pytest.mark.parametrize(
+    "value, key",
+    [
+        ("Café del Mar", "cafe del mar"),
+        ("ＡＢＣ!!", "abc"),
+        ("  Hello,   World ", "hello world"),
+        ("Song (feat. Guest)", "song"),
+        ("Song [ft. Guest] (Live)", "song live"),
+        ("Song (Featuring Guest)", "song"),
+        ("Artist feat. Other", "artist"),
+        ("Artist ft. Other", "artist"),
+        ("A Feat of Strength", "a feat of strength"),
+        ("Live at Ft Worth", "live at ft worth"),
+        ("Left Behind", "left behind"),
+        (None, ""),
+    ],
+)
+def test_match_key(value, key):
+    assert _match_key(value) == key
+
+
+def test_match_key_keeps_distinct_titles_apart():
+    assert _match_key("A Feat of Strength") != _match_key("A Feat of Clay")
+
+
+def test_exact_match_scores_one():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Intro"))
+    assert matcher.score(keys, MatchKeys.for_song(song("a", "Intro"))) == 1
+
+
+def test_missing_fields_are_left_out_of_the_score():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Intro", album="", track=0))
+    candidate = MatchKeys.for_song(song("a", "Intro", album="Other"))
+    assert matcher.score(keys, candidate) == 1
+
+
+def test_best_prefers_exact_title_over_variant():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Intro"))
+    candidates = [
+        MatchKeys.for_song(
+            song("live", "Intro (Live)", album="Live at X", duration=260)
+        ),
+        MatchKeys.for_song(song("studio", "Intro")),
+        MatchKeys.for_song(song("other", "Intro", artist="Someone Else")),
+    ]
+    assert matcher.best(keys, candidates).id == "studio"
+
+
+def test_best_rejects_candidates_below_threshold():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Intro"))
+    candidates = [
+        MatchKeys.for_song(
+            song("live", "Intro (Live)", album="Live at X", duration=260)
+        ),
+        MatchKeys.for_song(song("other", "Intro", artist="Someone Else")),
+    ]
+    assert matcher.best(keys, candidates) is None
+
+
+def test_best_reports_ambiguous_matches():
+    warnings = []
+
+    class Log:
+        def warning(self, message, *args):
+            warnings.append(message.format(*args))
+
+    matcher = SongMatcher(log=Log())
+    keys = MatchKeys.for_item(item("Intro"))
+    candidates = [
+        MatchKeys.for_song(song("a", "Intro")),
+        MatchKeys.for_song(song("b", "Intro")),
+    ]
+    assert matcher.best(keys, candidates).id == "a"
+    assert len(warnings) == 1
+    assert "b (Intro)" in warnings[0]
+
+
+def test_duration_outside_tolerance_lowers_score():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Intro"))
+    near = MatchKeys.for_song(song("near", "Intro", duration=202))
+    far = MatchKeys.for_song(song("far", "Intro", duration=230))
+    assert matcher.score(keys, near) == 1
+    assert matcher.score(keys, far) < matcher.score(keys, near)
+
+
+def test_different_title_on_same_album_is_no_match():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Intro", track=0))
+    outro = MatchKeys.for_song(song("outro", "Outro", duration=202))
+    assert matcher.score(keys, outro) == 0
+    assert matcher.best(keys, [outro]) is None
+
+
+def test_numbered_parts_are_different_songs():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Suite, Part 2", track=0))
+    part1 = MatchKeys.for_song(song("p1", "Suite, Part 1", track=3))
+    assert matcher.score(keys, part1) == 0
+
+
+def test_other_track_on_same_album_is_no_match():
+    matcher = SongMatcher()
+    keys = MatchKeys.for_item(item("Intro", track=4))
+    other = MatchKeys.for_song(song("a", "Intro", track=3))
+    assert matcher.score(keys, other) == 0
+    elsewhere = MatchKeys.for_song(song("b", "Intro", album="Hits", track=3))
+    assert matcher.score(keys, elsewhere) >= matcher.threshold
+
+
+def test_album_track_ignores_other_titles():
+    matcher = SongMatcher()
+    tracklist = [
+        MatchKeys.for_song(song("outro", "Outro", track=2)),
+        MatchKeys.for_song(song("p1", "Suite, Part 1", track=3)),
+        MatchKeys.for_song(song("p2", "Suite, Part 2", track=4)),
+    ]
+    for title, track, song_id in [
+        ("Intro", 0, None),
+        ("Intro", 2, None),
+        ("Suite, Part 2", 0, "p2"),
+    ]:
+        album_item = item(title, track=track)
+        assert _match_album_track(album_item, tracklist, matcher) == song_id
+
+
+def test_index_looks_up_by_musicbrainz_id():
+    index = CatalogIndex()
+    index.add(song("a", "Other Title", musicBrainzId="mbid"))
+    index.add(song("b", "Intro"))
+    assert index.lookup(item("Intro", mb_trackid="mbid")) == "a"
+
+
+def test_index_prefers_recording_on_same_album():
+    index = CatalogIndex()
+    index.add(song("single", "Intro", album="Single", musicBrainzId="m"))
+    index.add(song("album", "Intro", album="Record", musicBrainzId="m"))
+    assert index.lookup(item("Intro", mb_trackid="m")) == "album"
+
+
+def test_index_matches_normalized_keys():
+    index = CatalogIndex()
+    index.add(song("a", "Café (feat. Guest)"))
+    assert index.lookup(item("cafe")) == "a"
+
+
+def test_index_keeps_feat_words_in_titles_apart():
+    index = CatalogIndex()
+    index.add(song("strength", "A Feat of Strength"))
+    index.add(song("clay", "A Feat of Clay"))
+    assert index.lookup(item("A Feat of Clay")) == "clay"
+    assert index.lookup(item("A Feat of Strength")) == "strength"
+
+
+def test_index_finds_misspelled_titles():
+    index = CatalogIndex()
+    index.add(song("a", "Bohemian Rhapsody", artist="Queen"))
+    index.add(song("b", "Another One Bites the Dust", artist="Queen"))
+    assert index.lookup(item("Bohemian Rapsody", artist="Queen")) == "a"
+
+
+def test_index_returns_none_without_match():
+    index = CatalogIndex()
+    index.add(song("a", "Bohemian Rhapsody", artist="Queen"))
+    assert index.lookup(item("Something Else", artist="Nobody")) is None
+
+
+def test_index_looks_up_paths():
+    index = CatalogIndex(server_prefix="/music")
+    index.add(song("a", "Intro", path="music/Band/Record/01 Intro.mp3"))
+    assert index.lookup_path("Band/Record/01 Intro.mp3") == "a"
+    assert index.lookup_path("Band\\Record\\01 Intro.mp3") == "a"
+    assert index.lookup_path("Band/Record/02 Outro.mp3") is None
+
+
+def test_index_lookup_without_fuzzy_match():
+    index = CatalogIndex()
+    index.add(song("a", "Bohemian Rhapsody", artist="Queen"))
+    misspelled = item("Bohemian Rapsody", artist="Queen")
+    assert index.lookup(misspelled, fuzzy=False) is None
+    exact = item("Bohemian Rhapsody", artist="Queen")
+    assert index.lookup(exact, fuzzy=False) == "a"
+
+
+def test_cache_key_ignores_authentication_and_order():
+    key = ResponseCache.make_key(
+        "search3", {"query": "a", "songCount": 10, "u": "me", "t": "x"}, "v1"
+    )
+    assert key == ResponseCache.make_key(
+        "search3", {"songCount": 10, "s": "salt", "query": "a"}, "v1"
+    )
+    assert key != ResponseCache.make_key(
+        "search3", {"query": "a", "songCount": 10}, "v2"
+    )
+    assert key != ResponseCache.make_key(
+        "search3", {"query": "b", "songCount": 10}, "v1"
+    )
+
+
+def test_cache_returns_stored_responses(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), 60, 10)
+    cache.put("a", {"song": [1]})
+    assert cache.get("a") == {"song": [1]}
+    assert cache.get("b") is None
+
+
+def test_cache_entries_expire(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.db"), 60, 10)
+    cache.put("a", {})
+    clock.now += 60
+    assert cache.get("a") == {}
+    clock.now += 1
+    assert cache.get("a") is None
+
+
+def test_cache_evicts_least_recently_used(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / "cache.db"), 600, 3)
+    for key in "abc":
+        clock.now += 1
+        cache.put(key, {})
+    clock.now += 1
+    cache.get("a")
+    clock.now += 1
+    cache.put("d", {})
+    assert [key for key in "abcd" if cache.get(key) is not None] == ["a", "d"]
+
+
+def test_cache_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(path, 60, 10)
+    cache.put("a", {"ok": True})
+    cache.close()
+    assert ResponseCache(path, 60, 10).get("a") == {"ok": True}
+
+
+def test_retry_delay_grows_up_to_the_maximum(monkeypatch):
+    monkeypatch.setattr(subsonic.random, "uniform", lambda low, high: high)
+    policy = RetryPolicy(5, 1, 6)
+    assert [policy.delay(attempt) for attempt in range(1, 5)] == [1, 2, 4, 6]
+
+
+def test_retry_delay_follows_retry_after():
+    policy = RetryPolicy(3, 1, 30)
+    assert policy.delay(1, "12") == 12
+    assert policy.delay(1, "120") == 30
+    assert policy.delay(1, "Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+
+def test_retry_policy_makes_at_least_one_attempt():
+    assert RetryPolicy(0, 1, 1).attempts == 1
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(threshold=3, cooldown=60)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert not breaker.record(False)
+    assert breaker.allow()
+    assert breaker.record(False)
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_trial_through_after_cooldown(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=60)
+    breaker.record(False)
+    clock.now += 60
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(False)
+    assert not breaker.allow()
+    clock.now += 60
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.allow()
+    assert not breaker.is_open
+
+
+def test_failed_requests_are_retried(plugin, server):
+    server.statuses = [503, requests.exceptions.ConnectionError()]
+    url = "http://localhost:4533/rest/getScanStatus"
+    assert plugin.send_request(url, {}) is not None
+    assert len(server.requests) == 3
+    assert str(plugin.request_stats) == "1 completed, 0 failed, 0 aborted"
+
+
+def test_scrobbles_are_never_retried(plugin, server):
+    server.statuses = [503]
+    url = "http://localhost:4533/rest/scrobble"
+    assert plugin.send_request(url, {"id": "a", "time": 1}) is None
+    assert len(server.endpoint_requests("scrobble")) == 1
+    assert server.scrobbles == []
+
+
+def plays(lib, *times):
+    """Add one played item per time, with song ids ``s0``, ``s1``..."""
+    items = []
+    for number, played in enumerate(times):
+        item = Item(title=f"Song {number}", subsonic_id=f"s{number}")
+        item.plex_lastviewedat = played
+        lib.add(item)
+        items.append(item)
+    return items
+
+
+def test_scrobbles_are_batched_in_chronological_order(plugin, server, lib):
+    items = plays(lib, 300, 100, 200)
+    plugin.subsonic_scrobble(items, batch_size=2)
+    assert server.scrobbles == [
+        ("s1", 100000),
+        ("s2", 200000),
+        ("s0", 300000),
+    ]
+    assert len(server.endpoint_requests("scrobble")) == 2
+
+
+def test_rejected_batch_falls_back_to_single_scrobbles(plugin, server, lib):
+    server.reject_batches = True
+    items = plays(lib, 100, 200, 300)
+    plugin.subsonic_scrobble(items, batch_size=2)
+    assert [song_id for song_id, _ in server.scrobbles] == ["s0", "s1", "s2"]
+    # The rejected batch, then every play on its own
+    assert len(server.endpoint_requests("scrobble")) == 4
+
+
+def test_batch_lost_in_transit_is_not_resent(plugin, server, lib):
+    server.statuses = [503]
+    items = plays(lib, 100, 200, 300)
+    plugin.subsonic_scrobble(items, batch_size=2)
+    assert server.scrobbles == [("s2", 300000)]
+    assert len(server.endpoint_requests("scrobble")) == 2
+
+
+def test_scrobbled_plays_are_not_sent_again(plugin, server, lib):
+    items = plays(lib, 100, 200)
+    plugin.subsonic_scrobble(items)
+    plugin.subsonic_scrobble(items)
+    assert len(server.scrobbles) == 2
+
+    items[0].plex_lastviewedat = 400
+    plugin.subsonic_scrobble(items)
+    assert server.scrobbles[2:] == [("s0", 400000)]
+
+
+def test_failed_scrobbles_are_sent_again(plugin, server, lib):
+    server.statuses = [503]
+    items = plays(lib, 100, 200)
+    plugin.subsonic_scrobble(items)
+    assert server.scrobbles == [("s1", 200000)]
+    plugin.subsonic_scrobble(items)
+    assert server.scrobbles[1:] == [("s0", 100000)]
+
+
+def test_forced_scrobbles_ignore_the_ledger(plugin, server, lib):
+    items = plays(lib, 100)
+    plugin.subsonic_scrobble(items)
+    plugin.subsonic_scrobble(items, force=True)
+    assert server.scrobbles == [("s0", 100000)] * 2
+
+
+def pulled(lib, item):
+    """Read the pulled fields of `item` back from the library."""
+    item = lib.get_item(item.id)
+    return {
+        field: field_type.from_sql(item.get(field))
+        for field, field_type in SubsonicPlugin.item_types.items()
+    }
+
+
+def test_pull_writes_only_changed_user_data(plugin, server, lib, monkeypatch):
+    server.songs = [
+        {"id": "s0", "userRating": 4, "starred": "2024-01-01", "playCount": 3},
+        {"id": "s1", "playCount": 1},
+        {"id": "unknown", "userRating": 5},
+    ]
+    rated, played = plays(lib, 100, 200)
+    lib.add(Item(title="Not on the server"))
+
+    written = []
+    write = plugin._write_pulled_values
+
+    def record(lib, changes):
+        written.extend(item_id for item_id, _ in changes)
+        return write(lib, changes)
+
+    monkeypatch.setattr(plugin, "_write_pulled_values", record)
+    plugin.subsonic_pull_ratings(lib)
+    assert sorted(written) == [rated.id, played.id]
+
+    assert pulled(lib, rated) == {
+        "subsonic_userrating": 4,
+        "subsonic_starred": True,
+        "subsonic_playcount": 3,
+    }
+    assert pulled(lib, played) == {
+        "subsonic_userrating": 0,
+        "subsonic_starred": False,
+        "subsonic_playcount": 1,
+    }
+
+    written.clear()
+    plugin.subsonic_pull_ratings(lib)
+    assert written == []
+
+    server.songs[1]["playCount"] = 2
+    plugin.subsonic_pull_ratings(lib)
+    assert written == [played.id]
+    assert pulled(lib, played)["subsonic_playcount"] == 2
+
+
+def items_with_ids(lib):
+    """Add items whose subsonic_id is set, missing, empty and NULL."""
+    for title, artist in [
+        ("set", "Band"),
+        ("missing", "Band"),
+        ("empty", "Other"),
+        ("null", "Band"),
+    ]:
+        item = Item(title=title, artist=artist)
+        if title == "set":
+            item.subsonic_id = "s1"
+        elif title == "empty":
+            item.subsonic_id = ""
+        lib.add(item)
+        if title == "null":
+            with lib.transaction() as tx:
+                tx.mutate(
+                    "INSERT INTO item_attributes (entity_id, key, value) "
+                    "VALUES (?, 'subsonic_id', NULL)",
+                    (item.id,),
+                )
+
+
+def test_missing_flex_query_matches_missing_empty_and_null(lib):
+    items_with_ids(lib)
+    missing = MissingFlexQuery("subsonic_id")
+    assert missing.clause()[0] is not None
+    titles = {item.title for item in lib.items(missing)}
+    assert titles == {"missing", "empty", "null"}
+    # The Python test agrees with the SQL one
+    matched = {item.title for item in lib.items() if missing.match(item)}
+    assert matched == titles
+
+
+def test_missing_flex_query_combines_with_fixed_fields(lib):
+    items_with_ids(lib)
+    band = query.AndQuery(
+        [
+            query.MatchQuery("artist", "Band"),
+            MissingFlexQuery("subsonic_id"),
+        ]
+    )
+    assert band.clause()[0] is not None
+    assert {item.title for item in lib.items(band)} == {"missing", "null"}
+
+
+def counting_items(lib, monkeypatch):
+    """Count the queries ``lib.items()`` is called with."""
+    queries = []
+    items = lib.items
+
+    def count(item_query=None, *args, **kwargs):
+        queries.append(item_query)
+        return items(item_query, *args, **kwargs)
+
+    monkeypatch.setattr(lib, "items", count)
+    return queries
+
+
+def test_item_stream_pages_through_matching_items(lib, monkeypatch):
+    ids = [lib.add(Item(title=f"Song {number}")) for number in range(7)]
+    lib.add(Item(title="Other"))
+    queries = counting_items(lib, monkeypatch)
+    stream = ItemStream(
+        lib, query.SubstringQuery("title", "Song"), page_size=3
+    )
+    assert len(stream) == 7
+    assert queries == []
+    assert [item.id for item in stream] == ids
+    # Pages of 3, 3 and 1 items
+    assert len(queries) == 3
+
+
+def test_item_stream_page_boundary(lib):
+    ids = [lib.add(Item(title=f"Song {number}")) for number in range(6)]
+    stream = ItemStream(lib, query.TrueQuery(), page_size=3)
+    assert [item.id for item in stream] == ids
+
+
+def test_item_stream_with_missing_flex_query(lib):
+    items_with_ids(lib)
+    stream = ItemStream(lib, MissingFlexQuery("subsonic_id"), page_size=2)
+    assert len(stream) == 3
+    assert {item.title for item in stream} == {"missing", "empty", "null"}
+
+
+def test_item_stream_falls_back_for_flexible_field_queries(
+    lib, monkeypatch
+):
+    for title, mood in [("a", "calm"), ("b", "calm"), ("c", "loud")]:
+        lib.add(Item(title=title, artist="Band", mood=mood))
+    lib.add(Item(title="d", artist="Other", mood="calm"))
+    item_query, _ = parse_query_parts(["artist:Band", "mood:calm"], Item)
+    queries = counting_items(lib, monkeypatch)
+    stream = ItemStream(lib, item_query, page_size=1)
+    assert len(stream) == 2
+    assert sorted(item.title for item in stream) == ["a", "b"]
+    # The query is evaluated once, in Python
+    assert queries == [item_query]
+
+
+def test_journal_is_kept_only_for_resumed_runs(plugin):
+    store = plugin.state_store()
+    journal = Journal(store, "getids", flush_every=2)
+    journal.add(1)
+    assert Journal(store, "getids", resume=True).done == set()
+    journal.add(2)
+    assert Journal(store, "getids", resume=True).done == {1, 2}
+    assert Journal(store, "addrating", resume=True).done == set()
+
+    # A new run discards the journal of the previous one
+    Journal(store, "getids")
+    assert Journal(store, "getids", resume=True).done == set()
+
+    journal = Journal(store, "getids", resume=True)
+    journal.add(4)
+    journal.finish()
+    assert Journal(store, "getids", resume=True).done == set()
+
+
+def test_journal_records_items_once_their_write_commits(
+    plugin, lib, monkeypatch
+):
+    stored, broken = plays(lib, 100, 200)
+    store = Item.store
+
+    def failing_store(item, *args, **kwargs):
+        if item.id == broken.id:
+            raise sqlite3.OperationalError("database is locked")
+        return store(item, *args, **kwargs)
+
+    monkeypatch.setattr(Item, "store", failing_store)
+    journal = plugin.journal(False, "subsonic_getids")
+    with plugin.item_writer(journal) as writer:
+        writer.idle = 60
+        for item in (stored, broken):
+            item.subsonic_id = "new"
+            writer.put(item)
+        journal.flush()
+        assert plugin.journal(True, "subsonic_getids").done == set()
+    journal.flush()
+    assert plugin.journal(True, "subsonic_getids").done == {stored.id}
+
+
+def test_resumed_catalog_run_skips_journaled_items(plugin, server, lib):
+    server.songs = [
+        {"id": "a", "title": "A", "artist": "Band", "album": "Record"},
+        {"id": "b", "title": "B", "artist": "Band", "album": "Record"},
+    ]
+    done, pending = (
+        Item(title=title, artist="Band", album="Record") for title in "AB"
+    )
+    lib.add(done)
+    lib.add(pending)
+    interrupted = Journal(plugin.state_store(), "getids")
+    interrupted.add(done.id)
+    interrupted.flush()
+
+    journal = Journal(plugin.state_store(), "getids", resume=True)
+    plugin.subsonic_get_ids([done, pending], False, True, journal=journal)
+    assert lib.get_item(done.id).get("subsonic_id") is None
+    assert lib.get_item(pending.id).subsonic_id == "b"
+    journal.flush()
+    resumed = Journal(plugin.state_store(), "getids", resume=True)
+    assert resumed.done == {done.id, pending.id}